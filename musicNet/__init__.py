@@ -52,7 +52,7 @@ folder. The following lines should be uncommented (the leading hash mark should
 be deleted) and edited as shown::
 
     node_auto_indexing=true
-    node_keys_indexable=type
+    node_keys_indexable=type,contentHash,scoreId
     relationship_auto_indexing=true
     relationship_keys_indexable=type
 
@@ -84,20 +84,36 @@ Contents
 import os
 import sys
 import time
+import socket
 import random
+import tempfile
 import weakref
 import threading
+import collections
+import operator
 import unittest, doctest
 import json
 import sqlite3
+import hashlib
+import urlparse
+import Queue
 import py2neo
 import py2neo.neo4j
+import py2neo.cypher
 import music21
+try:
+    import numpy
+except ImportError:
+    numpy = None
 # from music21 import *
 
 # import logging
 # logging.basicConfig(filename='example.log',level=logging.DEBUG)
 
+# Increase this whenever a change to the import would change the nodes 
+# or relationships added for a score, so that scores are imported again.
+EXTRACTION_VERSION = 1
+
 
 def _prepDoctests():
     '''This function is run before starting doctests. 
@@ -133,35 +149,137 @@ def addMomentsToScore(score, forceAdd=False):
                              'Use the forceAdd=True argument to override.\n')
             return
 
-    attackLookup = {}
-    addNotesFromStream(attackLookup, score, 0)    
-    attackOffsets = attackLookup.keys()
-    attackOffsets.sort()
-    
-    import heapq
-    releaseOffsets = []
-    releaseLookup = {}
-    for offset in attackOffsets:
+    offsets, notes, attacks, sustains = getMomentArrays(score)
+    for i in range(len(offsets)):
         moment = Moment()
-        # drop any sustained notes that have passed
-        while (releaseOffsets and releaseOffsets[0] <= offset):
-            del releaseLookup[releaseOffsets[0]]
-            heapq.heappop(releaseOffsets)  # always returns the lowest element
         # add any current sustained notes to the moment
-        for r in releaseOffsets:
-            for n in releaseLookup[r]:
-                moment.addComponents(n, sameOffset=False)
+        if sustains[i]:
+            moment.addComponents([notes[x] for x in sustains[i]], sameOffset=False)
         # add any new onsets to the moment
-        # add a release reference for every note
-        notes = attackLookup[offset]
-        for note in notes:
-            moment.addComponents(note, sameOffset=True)
-            noteReleaseOffset = offset + note.quarterLength
-            if (noteReleaseOffset not in releaseOffsets):
-                heapq.heappush(releaseOffsets, noteReleaseOffset)
-                releaseLookup[noteReleaseOffset] = weakref.WeakSet()
-            releaseLookup[noteReleaseOffset].add(note)
-        score.insert(offset, moment)
+        moment.addComponents([notes[x] for x in attacks[i]], sameOffset=True)
+        score.insert(offsets[i], moment)
+
+def getMomentArrays(score):
+    '''Finds the moments in a :class:`~music21.stream.Score` without adding
+    :class:`Moment` objects to it. This is the sweep used by :meth:`addMomentsToScore`,
+    for callers that only need to know which notes sound together.
+    
+    Returns a tuple of four lists: the offsets of the moments (every offset at which
+    a note starts, in order), the notes in the score, and, for each moment, 
+    the indexes (into the list of notes) of the notes that start at that moment, 
+    and of the notes that started earlier and are still sounding.
+    
+    >>> from music21 import *
+    >>> bwv84_5 = corpus.parse('bach/bwv84.5.mxl')
+    >>> from music21.musicNet import *
+    >>> offsets, notes, attacks, sustains = getMomentArrays(bwv84_5)
+    >>> print len(offsets), len(attacks), len(sustains)
+    65 65 65
+    '''
+    notes = []
+    noteOffsets = []
+    _collectNotes(score, 0, notes, noteOffsets, set())
+    order = sorted(range(len(notes)), key=noteOffsets.__getitem__)
+    offsets = []
+    attacks = []
+    sustains = []
+    import heapq
+    releases = []  # heap of (release offset, note index)
+    sounding = set()
+    i = 0
+    while i < len(order):
+        offset = noteOffsets[order[i]]
+        # drop any sustained notes that have passed
+        while releases and releases[0][0] <= offset:
+            sounding.discard(heapq.heappop(releases)[1])
+        sustains.append(sorted(sounding))
+        # gather the new onsets and schedule their releases
+        attacked = []
+        while i < len(order) and noteOffsets[order[i]] == offset:
+            idx = order[i]
+            attacked.append(idx)
+            heapq.heappush(releases, (offset + notes[idx].quarterLength, idx))
+            i += 1
+        sounding.update(attacked)
+        offsets.append(offset)
+        attacks.append(attacked)
+    return offsets, notes, attacks, sustains
+
+def getSimultaneousNotePairs(score):
+    '''Finds every pair of notes in a :class:`~music21.stream.Score` that sound 
+    at the same time, once per pair no matter how many moments they share. 
+    This is used by :meth:`Database.addScore` to add `NoteSimultaneousWithNote` 
+    relationships.
+    
+    Returns a tuple of six lists: the notes in the score (as in :meth:`getMomentArrays`),
+    then, for each pair, the index of its first note, the index of its second note,
+    the harmonic interval between them in semitones (first minus second), 
+    that interval reduced to less than an octave (keeping its sign),
+    and 'True' or 'False' depending on whether the notes start at the same offset.
+    The first note of a pair is the one that starts later, or for notes that start 
+    together the one that comes first in the score.
+    
+    The intervals are calculated with NumPy when it is installed.
+
+    >>> from music21 import *
+    >>> bwv84_5 = corpus.parse('bach/bwv84.5.mxl')
+    >>> from music21.musicNet import *
+    >>> notes, starts, ends, cInts, sInts, sameOffsets = getSimultaneousNotePairs(bwv84_5)
+    >>> print len(starts) == len(set(zip(starts, ends)))
+    True
+    '''
+    offsets, notes, attacks, sustains = getMomentArrays(score)
+    starts = []
+    ends = []
+    sameOffsets = []
+    for i in range(len(offsets)):
+        attacked = attacks[i]
+        sustained = sustains[i]
+        for j in range(len(attacked)):
+            note1 = attacked[j]
+            for note2 in attacked[j + 1:]:
+                starts.append(note1)
+                ends.append(note2)
+                sameOffsets.append('True')
+            for note2 in sustained:
+                starts.append(note1)
+                ends.append(note2)
+                sameOffsets.append('False')
+    midi = [x.midi for x in notes]
+    if not starts:
+        cInts = sInts = []
+    elif numpy:
+        midi = numpy.array(midi)
+        cInts = midi[starts] - midi[ends]
+        sInts = numpy.sign(cInts) * (numpy.abs(cInts) % 12)
+        cInts = cInts.tolist()
+        sInts = sInts.tolist()
+    else:
+        cInts = [midi[x] - midi[y] for x, y in zip(starts, ends)]
+        sInts = [_signedModulo(x, 12) for x in cInts]
+    return notes, starts, ends, cInts, sInts, sameOffsets
+
+def _collectNotes(obj, offset, notes, noteOffsets, seen):
+    # The same traversal as addNotesFromStream(), collecting into flat lists.
+    try:
+        classes = obj._classes
+    except AttributeError:
+        return
+    if classes == None:
+        return
+    offset += obj.offset
+    if 'Stream' in classes:
+        for el in obj:
+            _collectNotes(el, offset, notes, noteOffsets, seen)
+        return
+    if 'Note' not in classes:
+        return
+    key = (offset, id(obj))
+    if key in seen:
+        return
+    seen.add(key)
+    notes.append(obj)
+    noteOffsets.append(offset)
 
 def addNotesFromStream(attackLookup, obj, offset):
     try:
@@ -183,6 +301,107 @@ def addNotesFromStream(attackLookup, obj, offset):
     except KeyError:
         attackLookup[offset] = weakref.WeakSet([obj])
 
+def getContentHash(score):
+    '''Returns a hash of a score's contents, used to recognize scores that have already
+    been added to the database (see :meth:`Database.addScore`). The score can be given
+    as a music21 :class:`~music21.stream.Score` or as a corpus file path. 
+    
+    Parsed scores are identified by the contents of the file they were parsed from, 
+    if there is one, or else by their MusicXML. The hash also depends on the 
+    module's :data:`EXTRACTION_VERSION`.
+    
+    >>> bwv84_5 = corpus.parse('bach/bwv84.5.mxl')
+    >>> getContentHash(bwv84_5) == getContentHash('bach/bwv84.5.mxl')
+    True
+    '''
+    contentHash = _fileContentHash(score)
+    if contentHash:
+        return contentHash
+    digest = hashlib.sha1('musicNet extraction %d\n' % EXTRACTION_VERSION)
+    musicxml = score.musicxml
+    if isinstance(musicxml, unicode):
+        musicxml = musicxml.encode('utf-8')
+    digest.update(musicxml)
+    return digest.hexdigest()
+
+def _fileContentHash(score):
+    # The content hash of a score's file, or None if it doesn't have one.
+    if isinstance(score, basestring):
+        filePath = score
+        if not os.path.isfile(filePath):
+            filePath = music21.corpus.getWork(score)
+            if isinstance(filePath, list):
+                filePath = filePath[0]
+    else:
+        filePath = getattr(score, 'filePath', None)
+    if not filePath or not os.path.isfile(filePath):
+        return None
+    digest = hashlib.sha1('musicNet extraction %d\n' % EXTRACTION_VERSION)
+    with open(filePath, 'rb') as fh:
+        digest.update(fh.read())
+    return digest.hexdigest()
+
+_graphServices = {}
+_graphServicesLock = threading.Lock()
+_graphServicesPid = None
+
+def getGraphDatabase(uri='http://localhost:7474/db/data/', **kwargs):
+    '''Returns the :class:`py2neo.neo4j.GraphDatabaseService` object for `uri` shared by 
+    every :class:`Database` and :class:`Results` object in this process, so that they reuse 
+    py2neo's pooled keep-alive connections instead of each discovering the server again. 
+    It is safe to call from any thread. A new process started by forking gets fresh 
+    objects and connections, since sockets can't be shared with the parent process.
+    '''
+    global _graphServicesPid
+    key = (uri, tuple(sorted(kwargs.items())))
+    with _graphServicesLock:
+        if _graphServicesPid != os.getpid():
+            # hack to get py2neo to play nice with multiprocessing
+            py2neo.packages.httpstream.http.ConnectionPool._puddles = {}
+            _graphServices.clear()
+            _graphServicesPid = os.getpid()
+        try:
+            return _graphServices[key]
+        except KeyError:
+            graph_db = py2neo.neo4j.GraphDatabaseService(uri, **kwargs)
+            _graphServices[key] = graph_db
+            return graph_db
+
+_importWorkerDatabase = None
+
+def _initImportWorker(uri, dbargs):
+    '''Sets up a Database object for an import worker process (see :meth:`Database.addScores`).
+    '''
+    global _importWorkerDatabase
+    _importWorkerDatabase = Database(uri, **dbargs)
+
+def _extractScoreForImport(path):
+    '''Parses a score, adds Moments, and extracts its nodes and edges in an import worker process.
+    Returns a tuple of the node rows, the edge rows, the score's content hash, and an 
+    :class:`ImportStats` object (with an `error` message if the score couldn't be extracted).
+    '''
+    db = _importWorkerDatabase
+    stats = ImportStats(path)
+    try:
+        stats.startPhase('moments')
+        score = music21.corpus.parse(path)
+        addMomentsToScore(score)
+        stats.endPhase('moments')
+        db._prepareImport(False, stats)
+        stats.startPhase('extraction')
+        db._extractNodes(score)
+        contentHash = _fileContentHash(score) or db.nodeFarm.getContentHash()
+        nodes, edges = db.nodeFarm.exportRows()
+        stats.endPhase('extraction')
+        stats.sqliteFlushes = db.nodeFarm.flushCount
+    except Exception as e:
+        stats.error = '%s: %s' % (e.__class__.__name__, e)
+        return None, None, None, stats
+    finally:
+        db.nodeFarm = None
+        db.importStats = None
+    return nodes, edges, contentHash, stats
+
 def _signedModulo(val, mod):
     ''' This modulo function will return both negative and positive numbers.
     '''
@@ -194,46 +413,187 @@ def _signedModulo(val, mod):
     return val
 
 class Results(threading.Thread):
+    '''Runs a Cypher query in a background thread, so that the first rows of a result
+    can be read before the query has finished. Rows are read with :meth:`next` or 
+    :meth:`fetch_all` after the thread is started.
     
-    def __init__(self, queryText, params=None):
+    No more than `bufferSize` rows are held at a time. When the buffer is full
+    the query waits for rows to be read, and :meth:`stop` ends the query.
+    If no rows are read for `idleSeconds` while the buffer is full, the reader is taken
+    to have gone and the query ends as if :meth:`stop` had been called.
+    The number of rows produced and consumed, and the time each side spent 
+    waiting for the other, are available from :meth:`counters`.
+    
+    The query is sent to the server of the :class:`Database` given as `db`,
+    or to the default location if there is none.
+    
+    If a `cursor` is given, the last column of each row is taken to be a 
+    pagination cursor (see :meth:`Query.results`), and the :attr:`cursor`
+    attribute is updated to the cursor of the last row read.
+    
+    If a list of `rows` is given, they are returned instead of running the query.
+    Otherwise, if a `cache` is given, the rows of a query that runs to completion
+    are stored in it under `cacheKey` (see :meth:`Query.results`).
+    '''
+    bufferSize = 5000
+    idleSeconds = 600
+    
+    def __init__(self, queryText, params=None, bufferSize=None, db=None, cursor=None, 
+                 rows=None, cache=None, cacheKey=None):
         threading.Thread.__init__(self)
-        py2neo.packages.httpstream.http.ConnectionPool._puddles = {}
+        # An abandoned query waiting for its buffer to empty shouldn't keep the process alive.
+        self.daemon = True
+        if db:
+            self.graph_db = db.graph_db
+        else:
+            self.graph_db = getGraphDatabase()
         self.queryText = queryText
         self.params = params
-        self.results = []
+        self.cursor = cursor
+        self.rows = rows
+        self.cache = cache
+        self.cacheKey = cacheKey
+        if bufferSize:
+            self.bufferSize = bufferSize
+        self.stream = None
+        self.buffer = collections.deque()
+        self.condition = threading.Condition()
+        self.finished = False
+        self.stopped = False
+        self.abandoned = False
+        self.lastRead = None
+        self.rowsProduced = 0
+        self.rowsConsumed = 0
+        self.producerWaitSeconds = 0.0
+        self.consumerWaitSeconds = 0.0
+        self.startTime = None
+        self.endTime = None
         
     def run(self):
-        db = Database()
-        query = py2neo.neo4j.CypherQuery(db.graph_db, self.queryText)
-        if self.params:
-            p = self.params
-            self.stream = query.stream(**p) 
-        else:
-            self.stream = query.stream()
-        for item in self.stream:
-            self.results.append(item)
+        self.startTime = time.time()
+        condition = self.condition
+        buffer = self.buffer
+        cached = None
+        if self.cache is not None and self.rows is None:
+            cached = []
+            cachedSize = 0
+        try:
+            if self.rows is not None:
+                source = self.rows
+            else:
+                query = py2neo.neo4j.CypherQuery(self.graph_db, self.queryText)
+                if self.params:
+                    p = self.params
+                    self.stream = query.stream(**p) 
+                else:
+                    self.stream = query.stream()
+                source = self.stream
+            for item in source:
+                if cached is not None:
+                    cachedSize += _rowSize(item)
+                    if cachedSize > self.cache.maxEntryBytes:
+                        cached = None
+                    else:
+                        cached.append(item)
+                with condition:
+                    if len(buffer) >= self.bufferSize and not self.stopped:
+                        waitStart = time.time()
+                        while len(buffer) >= self.bufferSize and not self.stopped:
+                            condition.wait(self.idleSeconds)
+                            if time.time() - max(self.lastRead or 0, waitStart) >= self.idleSeconds:
+                                # Nobody has read a row for too long.
+                                self.stopped = self.abandoned = True
+                                buffer.clear()
+                        self.producerWaitSeconds += time.time() - waitStart
+                    if self.stopped:
+                        break
+                    buffer.append(item)
+                    self.rowsProduced += 1
+                    condition.notify_all()
+            if cached is not None and not self.stopped:
+                self.cache.put(self.cacheKey, cached, cachedSize)
+            if self.abandoned and self.stream:
+                self.stream.close()
+        finally:
+            with condition:
+                self.finished = True
+                self.endTime = time.time()
+                condition.notify_all()
+
+    def _waitForRows(self):
+        # Called with the condition held. Returns False if no more rows will arrive.
+        if self.finished or not self.is_alive():
+            return False
+        waitStart = time.time()
+        self.condition.wait()
+        self.consumerWaitSeconds += time.time() - waitStart
+        return True
 
     def next(self, limit=10):
+        '''Returns a list of up to `limit` rows, waiting for them if necessary. 
+        The list is shorter (or empty) only if the query has finished.
+        '''
         output = []
-        for _ in range(limit):
-            while not self.results:
-                if self.is_alive():
-                    time.sleep(0.1)
-                else:
+        with self.condition:
+            while len(output) < limit:
+                if self.buffer:
+                    for _ in range(min(limit - len(output), len(self.buffer))):
+                        output.append(self.buffer.popleft())
+                    self.condition.notify_all()
+                elif not self._waitForRows():
                     break
-            if self.results:
-                output.append(self.results.pop(0))
-            else:
-                break
+            self._consumed(output)
         return output
     
     def fetch_all(self):
-        while self.is_alive():
-            time.sleep(0.1)
-        return self.results
+        '''Waits for the query to finish, and returns a list of all the rows not yet read.
+        '''
+        output = []
+        with self.condition:
+            while True:
+                output.extend(self.buffer)
+                self.buffer.clear()
+                self.condition.notify_all()
+                if not self._waitForRows():
+                    break
+            output.extend(self.buffer)
+            self.buffer.clear()
+            self._consumed(output)
+        return output
+    
+    def _consumed(self, rows):
+        self.lastRead = time.time()
+        self.rowsConsumed += len(rows)
+        if rows and self.cursor is not None:
+            self.cursor = rows[-1][-1]
     
     def stop(self):
-        self.stream.close()
+        '''Ends the query and discards any rows that haven't been read.
+        '''
+        with self.condition:
+            self.stopped = True
+            self.buffer.clear()
+            self.condition.notify_all()
+        if self.stream:
+            self.stream.close()
+    
+    def counters(self):
+        '''Returns a dict with the number of rows `produced` by the query and `consumed` by 
+        :meth:`next` and :meth:`fetch_all`, the number `buffered`, the seconds spent by the query
+        waiting for room in the buffer (`producerWait`) and by readers waiting for rows
+        (`consumerWait`), the `elapsed` time of the query, and the `rowsPerSecond` it produced.
+        '''
+        with self.condition:
+            elapsed = 0.0
+            if self.startTime:
+                elapsed = (self.endTime or time.time()) - self.startTime
+            return { 'produced': self.rowsProduced,
+                     'consumed': self.rowsConsumed,
+                     'buffered': len(self.buffer),
+                     'producerWait': self.producerWaitSeconds,
+                     'consumerWait': self.consumerWaitSeconds,
+                     'elapsed': elapsed,
+                     'rowsPerSecond': self.rowsProduced / max(elapsed, 0.001) }
     
 
 def _getPy2neoMetadata(node):
@@ -267,14 +627,188 @@ def _convertFromString(val):
 def _id(item):
     return item._id  # __dict__['_id']
 
-def _serverCall(func, *args):
-    while True:
-#       try:
-        r = func(*args)
-#        except py2neo.rest.SocketError:
-#            time.sleep(0.2)
-#            continue
-        return r
+_SERVER_RETRIES = 5
+
+def _serverCall(func, *args, **kwargs):
+    '''Calls a py2neo function, retrying with an increasing delay if the server can't be reached.
+    '''
+    return _retryServerCall(func, args, kwargs)
+
+def _retryServerCall(func, args, kwargs, onAttempt=None):
+    # onAttempt is called before each attempt, so retries can be counted.
+    delay = 0.2
+    for attempt in range(_SERVER_RETRIES):
+        if onAttempt:
+            onAttempt()
+        try:
+            return func(*args, **kwargs)
+        except (py2neo.packages.httpstream.http.SocketError, socket.error):
+            if attempt == _SERVER_RETRIES - 1:
+                raise
+            time.sleep(delay)
+            delay *= 2
+
+# Errors that show the server rejected a batch without writing any of it, 
+# which may mean the batch was too large.
+_BATCH_ERRORS = (py2neo.packages.httpstream.http.ClientError,)
+
+def _rowSize(row):
+    '''Estimates the memory used by a row of query results.
+    '''
+    size = sys.getsizeof(row)
+    for value in row:
+        size += sys.getsizeof(value)
+        if hasattr(value, '__dict__'):
+            size += sys.getsizeof(value.__dict__)
+    return size
+
+class _ResultCache(object):
+    '''A least-recently-used cache of query results, limited by the estimated size 
+    of the rows it holds. No single result larger than `maxEntryBytes` is stored. 
+    
+    When a result doesn't fit, the results used least recently are dropped:
+    
+    >>> cache = _ResultCache(300, maxEntryBytes=200)
+    >>> cache.put(('pattern a', '[]', 1), ['row a'], 100)
+    >>> cache.put(('pattern b', '[]', 1), ['row b'], 100)
+    >>> cache.get(('pattern a', '[]', 1))
+    ['row a']
+    >>> cache.put(('pattern c', '[]', 1), ['row c'], 150)
+    >>> cache.get(('pattern b', '[]', 1)) is None
+    True
+    >>> sorted(key[0] for key in cache.entries)
+    ['pattern a', 'pattern c']
+    
+    The keys used by :meth:`Database._results` end with the generation of the database,
+    so once it changes the results cached before are no longer found:
+    
+    >>> cache.get(('pattern a', '[]', 2)) is None
+    True
+    >>> stats = cache.stats()
+    >>> stats['hits'], stats['misses'], stats['evictions'], stats['bytes']
+    (1, 2, 1, 250)
+    '''
+    def __init__(self, maxBytes, maxEntryBytes=None):
+        self.maxBytes = maxBytes
+        self.maxEntryBytes = maxEntryBytes or maxBytes / 4
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            try:
+                rows, size = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self.entries[key] = (rows, size)
+            self.hits += 1
+            return rows
+
+    def put(self, key, rows, size):
+        if size > self.maxEntryBytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (rows, size)
+            self.bytes += size
+            while self.bytes > self.maxBytes:
+                oldKey, (oldRows, oldSize) = self.entries.popitem(last=False)
+                self.bytes -= oldSize
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return { 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                     'entries': len(self.entries), 'bytes': self.bytes, 'maxBytes': self.maxBytes }
+
+class _BatchSizer(object):
+    '''Chooses the size of write batches. The size is doubled as long as 
+    the time per entity keeps improving, and halved when a batch fails. 
+    After a failure it doesn't grow again until enough batches have succeeded.
+    
+    >>> sizer = _BatchSizer(size=100, minimum=10, maximum=400)
+    >>> sizer.succeeded(100, 1.0)
+    >>> sizer.succeeded(200, 1.0)
+    >>> sizer.size
+    400
+    >>> sizer.succeeded(400, 1.0)
+    >>> sizer.size
+    400
+    
+    A batch rejected by the server is split in half, and the size stays below that
+    of the failed batch:
+    
+    >>> sizer.failed(400)
+    0.2
+    >>> sizer.succeeded(200, 0.1)
+    >>> sizer.size, sizer.ceiling
+    (200, 200)
+    
+    The size is never split below the minimum, however often batches fail, 
+    and the ceiling is lifted once 50 batches in a row have succeeded:
+    
+    >>> for i in range(6):
+    ...     wait = sizer.failed(sizer.size)
+    >>> sizer.size, wait
+    (10, 6.4)
+    >>> for i in range(50):
+    ...     sizer.succeeded(10, 0.1)
+    >>> sizer.ceiling is None
+    True
+    '''
+    
+    def __init__(self, size=100, minimum=1, maximum=5000):
+        self.size = size
+        self.minimum = minimum
+        self.maximum = maximum
+        self.lastLatency = None
+        self.ceiling = None
+        self.failures = 0
+        self.successes = 0
+    
+    def succeeded(self, count, seconds):
+        self.failures = 0
+        self.successes += 1
+        if self.ceiling and self.successes >= 50:
+            self.ceiling = None
+        if count < self.size:
+            # A short batch (the end of the data or a split batch) says little about the size.
+            return
+        latency = seconds / count
+        if self.lastLatency is None or latency < self.lastLatency * 0.95:
+            self.size = max(min(self.size * 2, self.ceiling or self.maximum), self.size)
+        elif latency > self.lastLatency * 1.25:
+            self.size = max(self.size / 2, self.minimum)
+        self.lastLatency = latency
+    
+    def failed(self, count):
+        '''Halves the batch size and returns how long to wait before retrying.
+        '''
+        self.failures += 1
+        self.successes = 0
+        self.lastLatency = None
+        self.size = self.ceiling = max(min(self.size, count) / 2, self.minimum)
+        return min(0.1 * 2 ** self.failures, 10.0)
+
+# Statements for the transactional writer (see Database.useTransactions). 
+# Labels and relationship types can't be parameters, so there is one statement per type.
+_UNWIND_NODES = 'UNWIND {rows} AS row CREATE (n:%s) SET n = row.props RETURN row.i, id(n)'
+_UNWIND_RELATIONSHIPS = ('UNWIND {rows} AS row MATCH (a), (b) WHERE id(a) = row.start AND id(b) = row.end '
+                         'CREATE (a)-[r:%s]->(b) SET r = row.props')
+
+def _cypherName(name):
+    return '`%s`' % name.replace('`', '``')
 
 def _fix535(results, metadata):
     orderColumn = -1
@@ -288,32 +822,162 @@ def _fix535(results, metadata):
             results[i].pop(orderColumn)
 
 class NodeFarm():
+    '''Staging tables for the nodes and edges of a score while it is imported.
+    
+    By default the tables are kept in memory. If a `path` is given, they are kept in
+    a file-backed SQLite database instead, and no more than `cacheLimit` vertices
+    are kept in memory at a time; the rest are read back from the file when needed.
+    
+    The `journal` table records how far the import has got. With `resume` set to 
+    `True`, an existing file whose score was completely extracted is reopened 
+    (and :attr:`resumed` is `True`); otherwise the file is started over.
     
-    def __init__(self):
+    The rows staged in a file are the same as those staged in memory, even when
+    nodes have been dropped from memory and are looked up again. (As in
+    :meth:`Database._extractObject`, every node added is then updated.)
+    
+    >>> def stage(farm, notes):
+    ...     for i, n in enumerate(notes):
+    ...         parent = notes[i // 10 * 10] if i % 10 else None
+    ...         node = farm.addNode(n, parent)
+    ...         node['vertex']['index'] = i
+    ...         farm.updateNode(node, 'vertex', node['vertex'])
+    ...     for i in range(1, len(notes)):
+    ...         start = farm.getNodeFromObject(notes[i])
+    ...         end = farm.getNodeFromObject(notes[i - 1])
+    ...         farm.addEdge(start['hash'], 'NoteFollowsNote', end['hash'], 
+    ...                      {'index': start['vertex']['index']})
+    ...     node = farm.addNode(notes[0], None)
+    ...     farm.updateNode(node, 'vertex', dict(node['vertex'], index=len(notes)))
+    ...     return farm.exportRows()
+    >>> notes = [music21.note.Note() for i in range(30)]
+    >>> path = os.path.join(tempfile.mkdtemp(), 'staging.db')
+    >>> onDisk = NodeFarm(path, cacheLimit=5)
+    >>> nodes, edges = stage(onDisk, notes)
+    >>> onDisk.evicted, len(nodes), len(edges)
+    (True, 31, 29)
+    >>> (nodes, edges) == stage(NodeFarm(), notes)
+    True
+    >>> onDisk.close()
+    >>> os.path.exists(path)
+    False
+    '''
+    
+    def __init__(self, path=None, cacheLimit=None, resume=False):
         sqlite3.register_converter("JSON", json.loads)
-        # self.dbFile = './musicnet_import_%d.db' % os.getpid()
-        self.sqldb = sqlite3.connect('', detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+        self.path = path
+        self.cacheLimit = cacheLimit
+        self.resumed = False
+        # If set, every node read by getNodeBatch() is stamped with the ID of the score 
+        # it belongs to, which may only be known once the score has been extracted.
+        self.scoreId = None
+        if path:
+            if os.path.exists(path):
+                if resume and self._isExtracted(path):
+                    self.resumed = True
+                else:
+                    self._removeFiles()
+            self.sqldb = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+            self.sqldb.execute('PRAGMA journal_mode=WAL;')
+            self.sqldb.execute('PRAGMA synchronous=NORMAL;')
+        else:
+            self.sqldb = sqlite3.connect('', detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
         self.sqldb.row_factory = sqlite3.Row
         c = self.sqldb.cursor()
         # c.execute('DROP TABLE IF EXISTS nodeLookup;')
-        c.execute('CREATE TABLE nodeLookup (hash INTEGER, parentHash INTEGER, vertex JSON, nodeRef INTEGER);')
+        c.execute('CREATE TABLE IF NOT EXISTS nodeLookup (hash INTEGER, parentHash INTEGER, vertex JSON, nodeRef INTEGER, type TEXT);')
         # c.execute('DROP TABLE IF EXISTS edges;')
-        c.execute('CREATE TABLE edges (startNodeHash INTEGER, relationship TEXT, endNodeHash INTEGER, properties JSON);')
-        c.execute('CREATE INDEX nodeLookup_hash_IDX on nodeLookup (hash);')
+        c.execute('CREATE TABLE IF NOT EXISTS edges (startNodeHash INTEGER, relationship TEXT, endNodeHash INTEGER, properties JSON);')
+        c.execute('CREATE INDEX IF NOT EXISTS nodeLookup_hash_IDX on nodeLookup (hash);')
+        c.execute('CREATE TABLE IF NOT EXISTS journal (key TEXT PRIMARY KEY, value);')
         self.sqldb.commit()
-        self.writeBuffer = []
+        # Inserts and updates are buffered and written in bulk with executemany().
+        # Lookups are served from the in-memory index, so they never force a flush.
+        self.nodeBuffer = []
+        self.edgeBuffer = []
+        self.updateBuffer = {}
+        self.bufferLen = 0
+        self.nodeIndex = {}
+        # Vertex updates are merged in memory and each vertex is encoded once, 
+        # either when its row is inserted or when the node batches are read.
+        self.dirtyVertices = {}
+        self.flushCount = 0
+        # Once nodes have been dropped from the index to stay within cacheLimit,
+        # a node missing from the index is looked for in the table.
+        self.evicted = False
         
     def flushBuffer(self):
-        if len(self.writeBuffer) == 0:
+        if self.bufferLen == 0:
+            return
+        self.flushCount += 1
+        c = self.sqldb.cursor()
+        if self.nodeBuffer:
+            shared = self._sharedHashes()
+            rows = []
+            for h, p, v in self.nodeBuffer:
+                v = self._currentVertex(h, v, h in shared)
+                rows.append((h, p, json.dumps(v), v['type']))
+            c.executemany('INSERT INTO nodeLookup (hash, parentHash, vertex, type) VALUES (?, ?, ?, ?);', rows)
+        for column, values in self.updateBuffer.iteritems():
+            c.executemany('UPDATE nodeLookup SET %s = ? WHERE hash = ?;' % column, values)
+        if self.edgeBuffer:
+            c.executemany('INSERT INTO edges (startNodeHash, relationship, endNodeHash, properties) VALUES (?, ?, ?, ?);', 
+                          self.edgeBuffer)
+        self.sqldb.commit()
+        self.nodeBuffer = []
+        self.edgeBuffer = []
+        self.updateBuffer = {}
+        self.bufferLen = 0
+    
+    def flushVertices(self):
+        '''Writes all pending inserts and the final state of every updated vertex.
+        '''
+        self.flushBuffer()
+        if not self.dirtyVertices:
             return
+        self.flushCount += 1
         c = self.sqldb.cursor()
-        for command in self.writeBuffer:
-            c.execute(*command)
+        c.executemany('UPDATE nodeLookup SET vertex = ?, type = ? WHERE hash = ?;', 
+                      [(json.dumps(v), v['type'], h) for h, v in self.dirtyVertices.iteritems()])
         self.sqldb.commit()
-        self.writeBuffer = []
+        self.dirtyVertices = {}
+    
+    def _currentVertex(self, objHash, vertex, shared):
+        # An inserted row captures any pending update, unless another row
+        # for the same object is staged and still needs it.
+        if shared:
+            return self.dirtyVertices.get(objHash, vertex)
+        return self.dirtyVertices.pop(objHash, vertex)
+    
+    def _sharedHashes(self):
+        # The hashes of updated nodes in the buffer that have more than one row,
+        # in the buffer or in the table.
+        dirty = [h for h, p, v in self.nodeBuffer if h in self.dirtyVertices]
+        if not dirty:
+            return set()
+        shared = set()
+        seen = set()
+        for h in dirty:
+            if h in seen:
+                shared.add(h)
+            seen.add(h)
+        c = self.sqldb.cursor()
+        seen = list(seen)
+        for i in range(0, len(seen), 500):
+            chunk = seen[i:i + 500]
+            c.execute('SELECT DISTINCT hash FROM nodeLookup WHERE hash IN (%s);' % ', '.join('?' * len(chunk)), 
+                      chunk)
+            shared.update(row[0] for row in c)
+        return shared
+    
+    def _isInTable(self, objHash):
+        # Every node missing from the index after an eviction is either in the table or not staged.
+        c = self.sqldb.cursor()
+        c.execute('SELECT 1 FROM nodeLookup WHERE hash = ? LIMIT 1;', (objHash,))
+        return c.fetchone() is not None
     
     def addNode(self, obj, parent, vertex=None):
-        if len(self.writeBuffer) > 1000:
+        if self.bufferLen > 1000:
             self.flushBuffer()
         parentHash = parent
         if parent and not isinstance(parent, int):
@@ -322,30 +986,43 @@ class NodeFarm():
             vertex = {}
         if not 'type' in vertex:
             vertex['type'] = obj.__class__.__name__
-        vertexJSON = json.dumps(vertex)
         objHash = hash(obj)
+        self.nodeBuffer.append((objHash, parentHash, vertex))
+        self.bufferLen += 1
         values = { 'hash': objHash,
                    'parentHash': parentHash,
-                   'vertex': vertexJSON }
-        sql = 'INSERT INTO nodeLookup (hash, parentHash, vertex) VALUES (:hash, :parentHash, :vertex); '
-        self.writeBuffer.append((sql, values))
-        # return a copy of the node data with a real vertex
-        valuesCopy = values.copy()
-        valuesCopy['vertex'] = vertex
-        return valuesCopy
+                   'vertex': vertex }
+        # Like a SELECT on the table, lookups find the first node added for an object.
+        if objHash not in self.nodeIndex and not (self.evicted and self._isInTable(objHash)):
+            self.nodeIndex[objHash] = values
+            if self.cacheLimit and len(self.nodeIndex) > self.cacheLimit:
+                self._evictNodeIndex()
+        # return a copy of the node data
+        return values.copy()
+    
+    def _evictNodeIndex(self):
+        # Every node that leaves the index is written to the table, where 
+        # getNodeFromHash() can find it again.
+        self.flushBuffer()
+        self.evicted = True
+        self.nodeIndex = {}
     
     def updateNode(self, node, column, value):
-        if len(self.writeBuffer) > 1000:
-            self.flushBuffer()
         if column == 'vertex':
-            value = json.dumps(value)
-        values = { 'hashValue': node['hash'],
-                   'value': value }
-        sql = 'UPDATE nodeLookup SET %s = :value WHERE hash = :hashValue; ' % column
-        self.writeBuffer.append((sql, values))
+            self.dirtyVertices[node['hash']] = value
+            if self.cacheLimit and len(self.dirtyVertices) > self.cacheLimit:
+                self.flushVertices()
+            return
+        if self.bufferLen > 1000:
+            self.flushBuffer()
+        try:
+            self.updateBuffer[column].append((value, node['hash']))
+        except KeyError:
+            self.updateBuffer[column] = [(value, node['hash'])]
+        self.bufferLen += 1
     
     def addEdge(self, start, relation, end, properties=None):
-        if len(self.writeBuffer) > 1000:
+        if self.bufferLen > 1000:
             self.flushBuffer()
         startHash = start
         if not isinstance(start, int):
@@ -358,25 +1035,39 @@ class NodeFarm():
         values = { 'start': startHash,
                    'relation': relation,
                    'end': endHash }
+        props = None
         if properties:
-            sql = 'INSERT INTO edges (startNodeHash, relationship, endNodeHash, properties) VALUES (:start, :relation, :end, :props); '
-            values['props'] = json.dumps(properties)
-        else:
-            sql = 'INSERT INTO edges (startNodeHash, relationship, endNodeHash) VALUES (:start, :relation, :end); '
-        self.writeBuffer.append((sql, values))
+            props = values['props'] = json.dumps(properties)
+        self.edgeBuffer.append((startHash, relation, endHash, props))
+        self.bufferLen += 1
         return values
 
     def getNodeFromHash(self, hashVal):
-        self.flushBuffer()
+        try:
+            return self.nodeIndex[hashVal]
+        except KeyError:
+            # Until nodes are evicted, every staged node is in the index.
+            if not self.evicted:
+                return None
         c = self.sqldb.cursor()
-        c.execute('SELECT * FROM nodeLookup WHERE hash = ?;', (hashVal,))
-        return c.fetchone()
+        c.execute('SELECT hash, parentHash, vertex FROM nodeLookup WHERE hash = ? ORDER BY ROWID LIMIT 1;', 
+                  (hashVal,))
+        row = c.fetchone()
+        if row is None:
+            return None
+        values = { 'hash': row['hash'],
+                   'parentHash': row['parentHash'],
+                   'vertex': self.dirtyVertices.get(hashVal, row['vertex']) }
+        self.nodeIndex[hashVal] = values
+        if len(self.nodeIndex) > self.cacheLimit:
+            self._evictNodeIndex()
+        return values
     
     def getNodeFromObject(self, obj):
         return self.getNodeFromHash(hash(obj))
     
     def getNodeBatch(self, startIdx, limit=100):
-        self.flushBuffer()
+        self.flushVertices()
         c = self.sqldb.cursor()
         c.execute('SELECT * FROM nodeLookup WHERE ROWID >= :startIdx LIMIT :limit;', locals())
         results = []
@@ -384,14 +1075,592 @@ class NodeFarm():
             result = c.fetchone()
             if not result:
                 break
+            if self.scoreId:
+                result['vertex']['scoreId'] = self.scoreId
             results.append(result)
         return results
     
-    def getEdgeBatch(self, startIdx, limit=100):
+    def getEdgeBatch(self, startIdx, limit=100, withNodeRefs=False):
+        '''Returns a batch of edges. With `withNodeRefs` set to `True`, each edge also has
+        the `startNodeRef` and `endNodeRef` stored by :meth:`setNodeRefs`.
+        '''
         self.flushBuffer()
         c = self.sqldb.cursor()
-        c.execute('SELECT * FROM edges WHERE ROWID >= :startIdx LIMIT :limit;', locals())
+        if withNodeRefs:
+            # When several nodes share a hash, the last one written is used.
+            c.execute('SELECT e.*, '
+                      '(SELECT nodeRef FROM nodeLookup WHERE hash = e.startNodeHash ORDER BY ROWID DESC LIMIT 1) AS startNodeRef, '
+                      '(SELECT nodeRef FROM nodeLookup WHERE hash = e.endNodeHash ORDER BY ROWID DESC LIMIT 1) AS endNodeRef '
+                      'FROM edges e WHERE e.ROWID >= :startIdx LIMIT :limit;', locals())
+        else:
+            c.execute('SELECT * FROM edges WHERE ROWID >= :startIdx LIMIT :limit;', locals())
         return c.fetchall()    
+    
+    def getRootNodeRef(self):
+        '''Returns the nodeRef of the first node without a parent, which is the Score.
+        '''
+        c = self.sqldb.cursor()
+        c.execute('SELECT nodeRef FROM nodeLookup WHERE parentHash IS NULL ORDER BY ROWID LIMIT 1;')
+        row = c.fetchone()
+        if row is None:
+            return None
+        return row['nodeRef']
+    
+    def setNodeRefs(self, refs):
+        '''Stores the database node ID for each node, given a list of (hash, nodeRef) tuples.
+        '''
+        c = self.sqldb.cursor()
+        c.executemany('UPDATE nodeLookup SET nodeRef = ? WHERE hash = ?;', [(r, h) for h, r in refs])
+        self.sqldb.commit()
+    
+    def close(self, remove=True):
+        '''Closes the staging tables, and deletes them if they were kept in a file
+        (unless `remove` is `False`, so that the import can be resumed).
+        '''
+        self.sqldb.close()
+        if self.path and remove:
+            self._removeFiles()
+    
+    def _removeFiles(self):
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+    
+    def _isExtracted(self, path):
+        sqldb = sqlite3.connect(path)
+        try:
+            row = sqldb.execute("SELECT value FROM journal WHERE key = 'extracted';").fetchone()
+        except sqlite3.DatabaseError:
+            row = None
+        finally:
+            sqldb.close()
+        return bool(row and row[0])
+    
+    def getJournal(self, key):
+        '''Returns a value saved with :meth:`setJournal`, or 0 if there is none. The values used 
+        by :class:`Database` are `extracted` (1 once the score has been completely extracted), 
+        `rowsHash` (the hash of what was extracted, see :meth:`getContentHash`),
+        and `nodes` and `edges` (the last ROWID of each table committed to the database).
+        '''
+        c = self.sqldb.cursor()
+        c.execute('SELECT value FROM journal WHERE key = ?;', (key,))
+        row = c.fetchone()
+        if row is None:
+            return 0
+        return row['value']
+    
+    def setJournal(self, key, value):
+        '''Saves a value in the journal, after writing any pending changes to the tables.
+        '''
+        self.flushVertices()
+        c = self.sqldb.cursor()
+        c.execute('INSERT OR REPLACE INTO journal (key, value) VALUES (?, ?);', (key, value))
+        self.sqldb.commit()
+    
+    def countRows(self):
+        '''Returns the number of nodes and edges in the tables.
+        '''
+        self.flushBuffer()
+        c = self.sqldb.cursor()
+        nodes = c.execute('SELECT COUNT(*) FROM nodeLookup;').fetchone()[0]
+        edges = c.execute('SELECT COUNT(*) FROM edges;').fetchone()[0]
+        return nodes, edges
+
+    def exportRows(self):
+        '''Returns the contents of the node and edge tables as two lists of tuples, 
+        in insertion order, suitable for :meth:`importRows`.
+        '''
+        self.flushVertices()
+        c = self.sqldb.cursor()
+        c.execute('SELECT hash, parentHash, vertex FROM nodeLookup ORDER BY ROWID;')
+        nodes = [tuple(x) for x in c.fetchall()]
+        c.execute('SELECT startNodeHash, relationship, endNodeHash, properties FROM edges ORDER BY ROWID;')
+        edges = [tuple(x) for x in c.fetchall()]
+        return nodes, edges
+    
+    def getContentHash(self):
+        '''Returns a hash of the staged nodes and relationships, which identifies a score 
+        by what was extracted from it rather than by the objects it was extracted from.
+        '''
+        self.flushVertices()
+        digest = hashlib.sha1('musicNet extraction %d\n' % EXTRACTION_VERSION)
+        # Nodes are referred to by the position of the first row for their object.
+        position = '(SELECT MIN(ROWID) - 1 FROM nodeLookup WHERE hash = %s)'
+        c = self.sqldb.cursor()
+        c.execute('SELECT %s AS parent, n.vertex FROM nodeLookup n ORDER BY n.ROWID;' % (position % 'n.parentHash'))
+        for row in c:
+            digest.update(json.dumps([row['parent'], row['vertex']], sort_keys=True))
+        c.execute('SELECT %s AS start, e.relationship, %s AS end, e.properties FROM edges e ORDER BY e.ROWID;' 
+                  % (position % 'e.startNodeHash', position % 'e.endNodeHash'))
+        for row in c:
+            digest.update(json.dumps([row['start'], row['relationship'], row['end'], row['properties']], 
+                                     sort_keys=True))
+        return digest.hexdigest()
+
+    def getCatalog(self, valueLimit=1000):
+        '''Returns a :class:`_Catalog` of the staged nodes and edges.
+        '''
+        self.flushBuffer()
+        self.flushVertices()
+        catalog = _Catalog(valueLimit)
+        c = self.sqldb.cursor()
+        c.execute('SELECT vertex FROM nodeLookup ORDER BY ROWID;')
+        for row in c:
+            vertex = row['vertex']
+            catalog.add('nodes', vertex['type'], vertex)
+        # Relationships of a kind with the same properties are counted together.
+        nodeType = '(SELECT type FROM nodeLookup WHERE hash = %s ORDER BY ROWID DESC LIMIT 1)'
+        c.execute('SELECT relationship, properties, %s AS startType, %s AS endType, COUNT(*) AS count '
+                  'FROM edges e GROUP BY relationship, properties, startType, endType;' 
+                  % (nodeType % 'e.startNodeHash', nodeType % 'e.endNodeHash'))
+        for row in c:
+            catalog.add('relationships', row['relationship'], row['properties'] or {},
+                        (row['startType'], row['endType']), count=row['count'])
+        return catalog
+
+    def getScoreSummary(self):
+        '''Returns the entry of the staged score in the score index (see :meth:`Database.listScores`):
+        a dict with its `corpusFilepath`, the `movementName` of its Metadata, and the
+        `_names` of its contributors.
+        '''
+        self.flushBuffer()
+        self.flushVertices()
+        summary = { 'corpusFilepath': None, 'movementName': None, '_names': [] }
+        c = self.sqldb.cursor()
+        c.execute('SELECT vertex FROM nodeLookup ORDER BY ROWID;')
+        for row in c:
+            vertex = row['vertex']
+            nodeType = vertex['type']
+            if nodeType == 'Score' and summary['corpusFilepath'] is None:
+                summary['corpusFilepath'] = vertex.get('corpusFilepath')
+            elif nodeType == 'Metadata' and summary['movementName'] is None:
+                summary['movementName'] = vertex.get('movementName')
+            elif nodeType == 'Contributor' and vertex.get('_names') not in summary['_names']:
+                summary['_names'].append(vertex.get('_names'))
+        return _scoreEntry(summary)
+
+    def importRows(self, nodes, edges):
+        self.flushBuffer()
+        c = self.sqldb.cursor()
+        c.executemany('INSERT INTO nodeLookup (hash, parentHash, vertex, type) VALUES (?, ?, ?, ?);',
+                      ((h, p, json.dumps(v), v['type']) for h, p, v in nodes))
+        c.executemany('INSERT INTO edges (startNodeHash, relationship, endNodeHash, properties) VALUES (?, ?, ?, ?);',
+                      ((s, r, e, props if props is None else json.dumps(props)) for s, r, e, props in edges))
+        self.sqldb.commit()
+
+class _BulkImportFile(object):
+    '''One header file and one data file for the Neo4j offline import tool,
+    holding every node of one type or every relationship of one type. 
+    Rows are spooled to disk until :meth:`finish` is called, because the header
+    can't be written until all the property names and value types are known.
+    '''
+    
+    def __init__(self, directory, prefix, name, fixedColumns):
+        safeName = ''.join([x if x.isalnum() else '_' for x in name])
+        base = os.path.join(directory, '%s_%s' % (prefix, safeName))
+        self.headerPath = base + '_header.csv'
+        self.dataPath = base + '.csv'
+        self.spoolPath = base + '.spool'
+        self.fixedColumns = fixedColumns
+        self.columns = []
+        self.columnTypes = {}
+        self.rowCount = 0
+        self.spool = open(self.spoolPath, 'w')
+        
+    def add(self, fixedValues, properties):
+        for key, val in properties.iteritems():
+            if key not in self.columnTypes:
+                self.columns.append(key)
+                self.columnTypes[key] = set()
+            self.columnTypes[key].add(self._valueType(val))
+        self.spool.write(json.dumps([fixedValues, properties]) + '\n')
+        self.rowCount += 1
+    
+    def _valueType(self, val):
+        if val is None:
+            return None
+        if isinstance(val, bool):
+            return 'boolean'
+        if isinstance(val, (int, long)):
+            return 'long'
+        if isinstance(val, float):
+            return 'double'
+        return 'string'
+    
+    def _columnType(self, key):
+        kinds = self.columnTypes[key] - set([None])
+        if kinds == set(['boolean']):
+            return 'boolean'
+        if kinds and kinds <= set(['long']):
+            return 'long'
+        if kinds and kinds <= set(['long', 'double']):
+            return 'double'
+        return 'string'
+    
+    def _formatValue(self, val, columnType):
+        if val is None:
+            return ''
+        if columnType == 'boolean':
+            return 'true' if val else 'false'
+        if columnType == 'double':
+            return repr(float(val))
+        if isinstance(val, (list, dict)):
+            val = json.dumps(val)
+        elif isinstance(val, bool):
+            val = str(val)
+        if isinstance(val, unicode):
+            return val.encode('utf-8')
+        return str(val)
+    
+    def finish(self):
+        import csv
+        self.spool.close()
+        columnTypes = [self._columnType(x) for x in self.columns]
+        header = list(self.fixedColumns)
+        for key, columnType in zip(self.columns, columnTypes):
+            header.append('%s:%s' % (key.encode('utf-8'), columnType))
+        with open(self.headerPath, 'wb') as fh:
+            csv.writer(fh).writerow(header)
+        with open(self.dataPath, 'wb') as fh:
+            writer = csv.writer(fh)
+            for line in open(self.spoolPath):
+                fixedValues, properties = json.loads(line)
+                row = [self._formatValue(x, 'string') for x in fixedValues]
+                for key, columnType in zip(self.columns, columnTypes):
+                    row.append(self._formatValue(properties.get(key), columnType))
+                writer.writerow(row)
+        os.remove(self.spoolPath)
+
+def _cpuTime():
+    times = os.times()
+    return times[0] + times[1]
+
+#-------------------------------------------------------------------------------
+class ImportStats(object):
+    '''Timing and counts for the import of one score, as returned by
+    :meth:`Database.addScore` and :meth:`Database.addScores`.
+    
+    Each phase of the import (`moments`, `extraction`, `nodeWrite`, and `edgeWrite`)
+    records its wall-clock and CPU time in seconds. Times for the property callbacks 
+    are inclusive, so a callback that adds nodes also counts the time spent in
+    the callbacks for those nodes.
+    
+    >>> db = Database()
+    >>> db.wipeDatabase() # doctest: hide
+    >>> bwv84_5 = corpus.parse('bach/bwv84.5.mxl')
+    >>> stats = ImportStats('bach/bwv84.5.mxl')
+    >>> stats.startPhase('moments')
+    >>> addMomentsToScore(bwv84_5)
+    >>> stats.endPhase('moments') > 0
+    True
+    >>> stats = db.addScore(bwv84_5, stats=stats)
+    >>> print stats.nodeCount, stats.relationshipCount
+    456 1481
+    >>> print stats.relationshipCounts['NoteSimultaneousWithNote']
+    354
+    >>> sorted(stats.phases.keys())
+    ['catalog', 'edgeWrite', 'extraction', 'moments', 'nodeWrite']
+    >>> 'addPitchToNote' in stats.callbacks
+    True
+    '''
+    
+    _DOC_ORDER = [ 'startPhase', 'endPhase', 'asDict', 'toJSON', 'writeJSONLine' ]
+    _DOC_ATTR = {
+    'name': 'The name of the imported score, usually its corpus file path.',
+    'phases': 'A dict of phase names, each with a dict of `wall` and `cpu` seconds.',
+    'nodeCounts': 'A dict of the number of nodes written for each node type.',
+    'relationshipCounts': 'A dict of the number of relationships written for each relationship type.',
+    'callbacks': 'A dict of property callback names, each with a dict of `calls` and `seconds`.',
+    'sqliteFlushes': 'The number of times buffered rows were written to the SQLite staging tables.',
+    'serverCalls': 'The number of requests made to the Neo4j server during the import, including retries.',
+    'error': 'None, unless the score failed to import.',
+    'skipped': 'True if the score was already in the database and was not imported again.',
+    }
+    
+    def __init__(self, name=None):
+        self.name = name
+        self.phases = {}
+        self.nodeCounts = {}
+        self.relationshipCounts = {}
+        self.callbacks = {}
+        self.sqliteFlushes = 0
+        self.serverCalls = 0
+        self.error = None
+        self.skipped = False
+        self._phaseStarts = {}
+    
+    def __repr__(self):
+        return '<ImportStats %s: %d nodes, %d relationships>' % (self.name, self.nodeCount, self.relationshipCount)
+    
+    @property
+    def nodeCount(self):
+        return sum(self.nodeCounts.values())
+    
+    @property
+    def relationshipCount(self):
+        return sum(self.relationshipCounts.values())
+    
+    def startPhase(self, phase):
+        '''Starts timing a phase of the import.
+        '''
+        self._phaseStarts[phase] = (time.time(), _cpuTime())
+    
+    def endPhase(self, phase):
+        '''Stops timing a phase started with :meth:`startPhase` and returns its wall-clock time.
+        A phase that is timed more than once accumulates its times.
+        '''
+        wallStart, cpuStart = self._phaseStarts.pop(phase)
+        wall = time.time() - wallStart
+        totals = self.phases.setdefault(phase, {'wall': 0.0, 'cpu': 0.0})
+        totals['wall'] += wall
+        totals['cpu'] += _cpuTime() - cpuStart
+        return wall
+    
+    def _addCallbackTime(self, name, seconds):
+        try:
+            totals = self.callbacks[name]
+        except KeyError:
+            totals = self.callbacks[name] = {'calls': 0, 'seconds': 0.0}
+        totals['calls'] += 1
+        totals['seconds'] += seconds
+    
+    def _count(self, counts, kind, number=1):
+        counts[kind] = counts.get(kind, 0) + number
+    
+    def asDict(self):
+        '''Returns the statistics as a dict of plain values.
+        '''
+        return { 'score': self.name,
+                 'phases': self.phases,
+                 'nodes': self.nodeCounts,
+                 'relationships': self.relationshipCounts,
+                 'nodeCount': self.nodeCount,
+                 'relationshipCount': self.relationshipCount,
+                 'callbacks': self.callbacks,
+                 'sqliteFlushes': self.sqliteFlushes,
+                 'serverCalls': self.serverCalls,
+                 'skipped': self.skipped,
+                 'error': self.error }
+    
+    def toJSON(self):
+        '''Returns the statistics as a single line of JSON.
+        
+        >>> stats = ImportStats('bach/bwv84.5.mxl')
+        >>> print stats.toJSON()
+        {"callbacks": {}, "error": null, "nodeCount": 0, "nodes": {}, "phases": {}, "relationshipCount": 0, "relationships": {}, "score": "bach/bwv84.5.mxl", "serverCalls": 0, "skipped": false, "sqliteFlushes": 0}
+        '''
+        return json.dumps(self.asDict(), sort_keys=True)
+    
+    def writeJSONLine(self, fileHandle):
+        '''Appends the statistics to a JSON-lines log, given an open file.
+        '''
+        fileHandle.write(self.toJSON() + '\n')
+
+class _Catalog(object):
+    '''The types of nodes and relationships in the database, with the number of each,
+    the types of nodes each relationship type connects, and the values of their properties
+    with the number of entities that have each one.
+    No more than `valueLimit` distinct values are kept for a property.
+    It is kept up to date by :meth:`Database.addScore` (see :meth:`Database.listNodeTypes`).
+    
+    The catalog of the database is the sum of the catalogs of its scores, so deleting
+    a score subtracts its catalog again, and types and values no entity has any more 
+    are removed:
+    
+    >>> first = _Catalog()
+    >>> first.add('nodes', 'Note', {'pitch': 'C4'}, count=2)
+    >>> first.add('relationships', 'NoteInMeasure', {}, ('Note', 'Measure'), count=2)
+    >>> second = _Catalog()
+    >>> second.add('nodes', 'Note', {'pitch': 'D4'})
+    >>> second.add('nodes', 'Rest', {'duration': 1.0})
+    >>> second.add('relationships', 'NoteInMeasure', {}, ('Note', 'Measure'))
+    >>> catalog = _Catalog()
+    >>> catalog.merge(first)
+    >>> catalog.merge(second)
+    >>> sorted(catalog.counts('nodes').items())
+    [('Note', 3), ('Rest', 1)]
+    >>> catalog.subtract(second)
+    True
+    >>> catalog.toJSON() == first.toJSON()
+    True
+    >>> catalog.counts('nodes'), catalog.valueCounts('nodes', 'Note')
+    ({'Note': 2}, {'pitch': {'C4': 2}})
+    '''
+    def __init__(self, valueLimit=1000):
+        self.valueLimit = valueLimit
+        self.sections = {'nodes': {}, 'relationships': {}}
+    
+    def _entry(self, kind, entityType):
+        try:
+            return self.sections[kind][entityType]
+        except KeyError:
+            entry = self.sections[kind][entityType] = { 'count': 0, 'properties': {}, 
+                                                        'truncated': set(), 'ends': {} }
+            return entry
+    
+    def _addValues(self, entry, prop, values):
+        # values is a list of (value, count) pairs.
+        if prop in entry['truncated']:
+            return
+        known = entry['properties'].setdefault(prop, {})
+        for value, count in values:
+            if isinstance(value, list):
+                value = tuple(value)
+            try:
+                known[value] = known.get(value, 0) + count
+            except TypeError:
+                value = unicode(value)
+                known[value] = known.get(value, 0) + count
+        if len(known) > self.valueLimit:
+            entry['truncated'].add(prop)
+            del entry['properties'][prop]
+    
+    def add(self, kind, entityType, properties, ends=None, count=1):
+        entry = self._entry(kind, entityType)
+        entry['count'] += count
+        for prop, value in properties.iteritems():
+            if prop not in ('type', 'scoreId'):
+                self._addValues(entry, prop, [(value, count)])
+        if ends:
+            entry['ends'][ends] = entry['ends'].get(ends, 0) + count
+    
+    def merge(self, other):
+        for kind, section in other.sections.iteritems():
+            for entityType, otherEntry in section.iteritems():
+                entry = self._entry(kind, entityType)
+                entry['count'] += otherEntry['count']
+                for ends, count in otherEntry['ends'].iteritems():
+                    entry['ends'][ends] = entry['ends'].get(ends, 0) + count
+                for prop in otherEntry['truncated']:
+                    entry['truncated'].add(prop)
+                    entry['properties'].pop(prop, None)
+                for prop, values in otherEntry['properties'].iteritems():
+                    self._addValues(entry, prop, values.items())
+    
+    def subtract(self, other):
+        '''Removes the entities counted in `other`, the catalog of a deleted score. 
+        Returns False if the values of a property were dropped because there were too many
+        of them, since they can only be counted again from the catalogs of the remaining scores.
+        '''
+        exact = True
+        for kind, section in other.sections.iteritems():
+            for entityType, otherEntry in section.iteritems():
+                entry = self.sections[kind].get(entityType)
+                if entry is None:
+                    continue
+                entry['count'] -= otherEntry['count']
+                if entry['count'] <= 0:
+                    del self.sections[kind][entityType]
+                    continue
+                for ends, count in otherEntry['ends'].iteritems():
+                    remaining = entry['ends'].get(ends, 0) - count
+                    if remaining > 0:
+                        entry['ends'][ends] = remaining
+                    else:
+                        entry['ends'].pop(ends, None)
+                if entry['truncated'] & (set(otherEntry['properties']) | otherEntry['truncated']):
+                    exact = False
+                for prop, values in otherEntry['properties'].iteritems():
+                    known = entry['properties'].get(prop)
+                    if known is None:
+                        continue
+                    for value, count in values.iteritems():
+                        remaining = known.get(value, 0) - count
+                        if remaining > 0:
+                            known[value] = remaining
+                        else:
+                            known.pop(value, None)
+                    if not known:
+                        del entry['properties'][prop]
+        return exact
+    
+    def counts(self, kind):
+        return dict((t, e['count']) for t, e in self.sections[kind].iteritems())
+    
+    def valueCounts(self, kind, entityType):
+        '''Returns a dict of property names, each with a dict of the number of entities
+        of the type with each value. Properties with too many values are left out.
+        '''
+        entry = self.sections[kind].get(entityType)
+        if entry is None:
+            return {}
+        return entry['properties']
+    
+    def relationshipTypes(self):
+        return [{ 'start': start, 'type': rType, 'end': end, 'count': count } 
+                for rType, entry in sorted(self.sections['relationships'].iteritems())
+                for (start, end), count in sorted(entry['ends'].iteritems())]
+    
+    def properties(self, kind):
+        '''Returns a list of (type, property name) tuples, and a list of 
+        (type, property name, (value1, value2, ...)) tuples.
+        '''
+        properties = []
+        values = []
+        for entityType, entry in sorted(self.sections[kind].iteritems()):
+            for prop in sorted(set(entry['properties']) | entry['truncated']):
+                properties.append((entityType, prop))
+                values.append((entityType, prop, tuple(sorted(entry['properties'].get(prop, ())))))
+        return properties, values
+    
+    def toJSON(self):
+        sections = {}
+        for kind, section in self.sections.iteritems():
+            sections[kind] = {}
+            for entityType, entry in section.iteritems():
+                sections[kind][entityType] = { 
+                    'count': entry['count'], 
+                    'properties': dict((p, sorted([x, n] for x, n in v.iteritems())) 
+                                       for p, v in entry['properties'].iteritems()),
+                    'truncated': sorted(entry['truncated']),
+                    'ends': sorted([s, e, n] for (s, e), n in entry['ends'].iteritems()) }
+        return json.dumps({ 'valueLimit': self.valueLimit, 'valueCounts': True, 'sections': sections }, 
+                          sort_keys=True)
+    
+    @classmethod
+    def fromJSON(cls, text):
+        data = json.loads(text)
+        catalog = cls(data['valueLimit'])
+        def value(x):
+            return tuple(x) if isinstance(x, list) else x
+        def valueCounts(values):
+            if not data.get('valueCounts'):
+                # Catalogs stored before values were counted list each value once.
+                return dict((value(x), 1) for x in values)
+            return dict((value(x), n) for x, n in values)
+        for kind, section in data['sections'].iteritems():
+            for entityType, entry in section.iteritems():
+                catalog.sections[kind][entityType] = {
+                    'count': entry['count'],
+                    'properties': dict((p, valueCounts(v)) for p, v in entry['properties'].iteritems()),
+                    'truncated': set(entry['truncated']),
+                    'ends': dict(((x[0], x[1]), x[2]) for x in entry['ends']) }
+        return catalog
+
+def _scoreCatalogLookup(scoreIds):
+    # An index query for the MusicNetScoreCatalog nodes of the given scores.
+    quoted = ['"%s"' % x.replace('\\', '\\\\').replace('"', '\\"') for x in scoreIds]
+    return 'type:MusicNetScoreCatalog AND scoreId:(%s)' % ' '.join(quoted)
+
+def _scoreEntry(summary):
+    # A score without contributors is listed with _names [None], as it always has been.
+    return { 'corpusFilepath': summary.get('corpusFilepath'),
+             'movementName': summary.get('movementName'),
+             '_names': list(summary.get('_names') or []) or [None] }
+
+def _scoreSortKey(sortBy):
+    '''Returns the key function that orders entries of the score index by `sortBy`,
+    which is `movementName`, `corpusFilepath` or `composer`. Missing values sort last.
+    '''
+    def text(val):
+        if val is None:
+            return (True, u'')
+        return (False, unicode(val).lower())
+    if sortBy == 'composer':
+        return lambda entry: min(text(x) for x in entry['_names'])
+    if sortBy not in ('movementName', 'corpusFilepath'):
+        raise ValueError('Scores can be sorted by movementName, corpusFilepath or composer, not %r' % sortBy)
+    return lambda entry: text(entry[sortBy])
 
 #-------------------------------------------------------------------------------
 class Database(object):
@@ -409,12 +1678,31 @@ class Database(object):
     GraphDatabaseService('http://localhost:7474/db/data/')
     '''
     
-    _DOC_ORDER = [ 'wipeDatabase', 'addScore', 'listScores', 'listNodeTypes', 'listNodeProperties',
+    _DOC_ORDER = [ 'wipeDatabase', 'addScore', 'addScores', 'hasScore', 'deleteScore', 'replaceScore', 'exportImportFiles', 'cacheStats', 'rebuildCatalog', 'listScores', 'listNodeTypes', 'listNodeProperties',
                    'listRelationshipTypes', 'listRelationshipProperties', 'addPropertyCallback' ]
     _DOC_ATTR = {
     'graph_db': 'The instance of a :class:`py2neo.neo4j.GraphDatabaseService` object connected to this object, which is in turn connected to a Neo4j server either at the default location on the present computer, or the one specified by the Database `uri` argument.',
+    'batchSize': 'The number of nodes or relationships in the first request when a score is written. The size of later requests is adjusted to the speed of the server, up to :attr:`maxBatchSize`.',
+    'maxBatchSize': 'The largest number of nodes or relationships sent in one request, unless :attr:`useTransactions` is `True`.',
+    'stagingCacheLimit': 'The number of vertices kept in memory when a score is staged in a file (see :meth:`addScore`).',
+    'useTransactions': 'If `True`, scores are written with batched Cypher statements in explicit transactions, which is much faster but requires Neo4j 2.1 or newer. Nodes written this way are also labelled with their `type`.',
+    'transactionBatchSize': 'The number of nodes or relationships sent in each request when :attr:`useTransactions` is `True`. Run `scripts/benchmark.py writes` to compare sizes on a server.',
+    'commitSize': 'The number of nodes or relationships written in each transaction when :attr:`useTransactions` is `True`. An import that fails loses at most this many entities, which `resume` writes again (see :meth:`addScore`).',
+    'resultCacheBytes': 'The approximate memory used to cache the results of queries run with :meth:`Query.results`. Set it to 0 before creating the Database to turn off the cache.',
+    'generationCheckSeconds': 'How long the database generation is trusted before it is read again from the server, which is how long results cached by this object can outlive changes made by other processes (see :meth:`cacheStats`).',
+    'resultCache': 'The cache of query results, or None if :attr:`resultCacheBytes` is 0.',
+    'catalogValueLimit': 'The number of distinct values of a property kept in the catalog of the database (see :meth:`listNodeTypes`). Properties with more values are listed without values.',
     }
     HIDEFROMDATABASE = 1
+    batchSize = 100
+    maxBatchSize = 5000
+    stagingCacheLimit = 20000
+    useTransactions = False
+    transactionBatchSize = 2000
+    commitSize = 20000
+    resultCacheBytes = 64 * 1024 * 1024
+    generationCheckSeconds = 1.0
+    catalogValueLimit = 1000
 
     def __init__(self, uri='http://localhost:7474/db/data/', **kwargs):
         self.uri = uri
@@ -423,7 +1711,20 @@ class Database(object):
         self._db_kwargs = kwargs
         self._db_uri = uri
         self._callbacks = {}
+        self._callbackDispatch = {}
+        self._nodeBatchSizer = _BatchSizer(self.batchSize, maximum=self.maxBatchSize)
+        self._edgeBatchSizer = _BatchSizer(self.batchSize, maximum=self.maxBatchSize)
+        self._propertyRules = {}
+        self._valueKinds = {}
         self._extractState = {}
+        self.importStats = None
+        self.resultCache = None
+        if self.resultCacheBytes:
+            self.resultCache = _ResultCache(self.resultCacheBytes)
+        self._generation = None
+        self._generationChecked = None
+        self._relationshipTypeCounts = None
+        self._catalogHinted = False
         self._defaultCallbacks()
         self._m21SuperclassLookup = self._inspectMusic21ExpressionsArticulations()
         self._skipProperties = ('_activeSite', 'id', '_classes', 'groups', 'sites',
@@ -436,86 +1737,525 @@ class Database(object):
 
     def _refreshGraphDB(self):
         try:
-            self.graph_db = py2neo.neo4j.GraphDatabaseService(self.uri, **self.dbargs)
+            self.graph_db = getGraphDatabase(self.uri, **self.dbargs)
         except py2neo.packages.httpstream.http.SocketError:
         # 1.4: except py2neo.rest.SocketError:
             sys.exit('Unable to connect to database.\n')
 
-    def wipeDatabase(self):
-        '''Removes all relationships and nodes from the database.
+    def wipeDatabase(self, bulk=False, chunkSize=10000, verbose=False):
+        '''Removes all relationships and nodes from the database.
+        
+        By default the entities are fetched from the database 100 at a time and deleted. 
+        With the `bulk` argument set to `True`, they are instead deleted on the server
+        by repeated queries of no more than `chunkSize` nodes (and their relationships),
+        without being fetched, and the number of nodes deleted is returned. 
+        With the `verbose` argument set to `True`, the progress of a bulk wipe is 
+        written to stderr.
+
+        >>> db = Database()
+        >>> db.wipeDatabase()
+        >>> print db.graph_db.get_relationship_count()
+        0
+        >>> print db.graph_db.get_node_count()
+        1
+        >>> bwv84_5 = corpus.parse('bach/bwv84.5.mxl')  # doctest: hide
+        >>> addMomentsToScore(bwv84_5)                  # doctest: hide
+        >>> stats = db.addScore(bwv84_5)                # doctest: hide
+
+        The node count can never go below 1 because Neo4j always keeps a reference node 
+        in its network graph. The MusicNetMetadata node (see :meth:`cacheStats`) is removed
+        before the score nodes, so only those are counted.
+        
+        >>> db.wipeDatabase(bulk=True)
+        456
+        >>> print db.graph_db.get_node_count()
+        1
+        >>> stats = db.addScore(bwv84_5)                # doctest: hide
+        '''
+        self._dropGeneration()
+        self._forgetSchema()
+        self._relationshipTypeCounts = None
+        if bulk:
+            return self._deleteInChunks('START n=node:node_auto_index("type:*") ', chunkSize, verbose)
+        q = Query(self)
+        q.setStartRelationship()
+        rGen = q.results(cache=False)
+        while True:
+            results = rGen.next(limit=100)
+            if not results:
+                break
+            results = [x[0] for x in results]
+            self._serverCall(self.graph_db.delete, *results)
+        q = Query(self)
+        q.setStartNode()
+        rGen = q.results(cache=False)
+        while True:
+            results = rGen.next(limit=100)
+            if not results:
+                break
+            results = [x[0] for x in results]
+            self._serverCall(self.graph_db.delete, *results)
+
+    def addScore(self, score, verbose=False, stats=None, stagingFile=None, skipIfPresent=False, resume=False):
+        '''Adds a music21 :class:`~music21.stream.Score` to the database.
+        To see progress on the import, we can set the `verbose` argument to `True`.
+        
+        Returns an :class:`ImportStats` object with the timing and counts for the import.
+        An existing ImportStats object (for example, one that already timed 
+        the `moments` phase) can be passed as the `stats` argument to be filled in.
+        
+        The extracted nodes and relationships are staged in memory before they are written 
+        to the database. For very large scores, a file name can be given as the `stagingFile` 
+        argument to stage them on disk instead, keeping no more than :attr:`stagingCacheLimit`
+        vertices in memory. The file is deleted when the import is finished.
+        
+        With the `resume` argument set to `True`, the score is staged on disk (in the
+        `stagingFile`, or else in a file in the temporary directory named for the hash of 
+        the file the score was parsed from) along with a journal of the batches that have 
+        been written. A score that wasn't parsed from a file needs a `stagingFile`.
+        If the import fails, calling this method again with `resume` set to `True` 
+        continues from the last batch written instead of starting over. (Since the
+        server doesn't report which parts of a failed request were written, the batch that
+        was being written when the import failed may be written twice.) The score is 
+        extracted again to check that it is the one that was staged, and a ValueError is 
+        raised if it was changed since.
+        
+        Every node of the score has a `scoreId` property, which is the score's content hash
+        and can be used to delete it with :meth:`deleteScore`. A score parsed from a file
+        has the hash of the file (see :func:`getContentHash`); any other score has a hash of 
+        the nodes and relationships extracted from it. 
+        Once all of a score's nodes and relationships have been written, its Score node
+        is also given a `contentHash` property, and a `rowsHash` property with the hash 
+        of what was extracted. The database generation is changed 
+        when the writing starts and when it ends (see :meth:`cacheStats`), so the database 
+        has one node more than the score.
+        With the `skipIfPresent` argument set to `True`, a score whose hash is already in the 
+        database isn't added again, and the `skipped` attribute of the returned 
+        ImportStats is `True`. A score parsed from a file is looked up by the hash of its
+        file before anything is extracted, so a copy that was changed after it was parsed 
+        is skipped too; any other score has to be extracted to find its hash. The lookup uses 
+        the automatic index, so `contentHash` should be listed in `node_keys_indexable` 
+        (see the module documentation).
+        
+        In order to be able to access vertical note relationships such as
+        `NoteSimultaneousWithNote` and `MomentInNote`,
+        we need to add :class:`Moment` objects to the score using the 
+        module-level :meth:`addMomentsToScore` method before calling this method.
+        
+        >>> db = Database()
+        >>> db.wipeDatabase() # doctest: hide
+        >>> bwv84_5 = corpus.parse('bach/bwv84.5.mxl')
+        >>> addMomentsToScore(bwv84_5)
+        >>> stats = db.addScore(bwv84_5)
+        >>> print db.graph_db.get_node_count()
+        458
+        >>> print db.graph_db.get_relationship_count()
+        1481
+        >>> print stats.nodeCount, stats.relationshipCount
+        456 1481
+        >>> db.addScore(bwv84_5, skipIfPresent=True).skipped
+        True
+        '''
+        if stats is None:
+            stats = ImportStats(getattr(score, 'corpusFilepath', None))
+        contentHash = _fileContentHash(score)
+        if skipIfPresent and contentHash and self.hasScore(contentHash):
+            # A score parsed from a file is looked up before anything is extracted.
+            stats.skipped = True
+            return stats
+        if resume and not stagingFile:
+            if not contentHash:
+                raise ValueError('A score that was not parsed from a file needs a stagingFile to be resumed')
+            stagingFile = os.path.join(tempfile.gettempdir(), 'musicNet_import_%s.db' % contentHash)
+        self._prepareImport(verbose, stats, stagingFile, resume)
+        try:
+            if self.nodeFarm.resumed:
+                self._checkResumedScore(score)
+                self.maxNodes, self.maxEdges = self.nodeFarm.countRows()
+                if verbose:
+                    sys.stderr.write('Resuming import of %d nodes and %d relationships\n' 
+                                     % (self.maxNodes, self.maxEdges))
+            else:
+                if verbose:
+                    self.lastProgress = 0
+                    self._extractState['partItemMax'] = sum([len(x) for x in score.parts])
+                    sys.stderr.write('Extracting music21 objects..........')
+                stats.startPhase('extraction')
+                self._extractNodes(score)
+                self.nodeFarm.setJournal('rowsHash', self.nodeFarm.getContentHash())
+                self.nodeFarm.setJournal('extracted', 1)
+                self._endPhase('extraction')
+            rowsHash = self.nodeFarm.getJournal('rowsHash')
+            if not contentHash:
+                contentHash = rowsHash
+                if skipIfPresent and self.hasScore(contentHash):
+                    stats.skipped = True
+                    self.nodeFarm.close()
+                    self.nodeFarm = None
+                    self.importStats = None
+                    return stats
+            self.nodeFarm.scoreId = contentHash
+            self._extractState['contentHash'] = contentHash
+            self._extractState['rowsHash'] = rowsHash
+            self._writeNodesToDatabase()        
+            self._writeEdgesToDatabase(score)
+            self._storeContentHash()
+        except:
+            # Keep the staging file for a later resume.
+            self.nodeFarm.close(remove=not resume)
+            self.nodeFarm = None
+            self.importStats = None
+            raise
+        stats.sqliteFlushes = self.nodeFarm.flushCount
+        self.nodeFarm.close()
+        self.nodeFarm = None
+        self.importStats = None
+        return stats
+
+    def _checkResumedScore(self, score):
+        '''Raises a ValueError if `score` doesn't extract to the rows in the staging file 
+        being resumed, as when it was changed after a failed import. The score is extracted 
+        to another file next to the staging file, so it also isn't held in memory.
+        '''
+        staged = self.nodeFarm
+        verbose = self._extractState['verbose']
+        self._extractState['verbose'] = False
+        self.nodeFarm = NodeFarm(staged.path + '-check', self.stagingCacheLimit)
+        try:
+            self._extractNodes(score)
+            rowsHash = self.nodeFarm.getContentHash()
+        finally:
+            self.nodeFarm.close()
+            self.nodeFarm = staged
+            self._extractState['verbose'] = verbose
+        if rowsHash != staged.getJournal('rowsHash'):
+            raise ValueError('The score has changed since it was staged in %s; delete the file '
+                             'and the part of the score already written to start over' % staged.path)
+
+    def addScores(self, paths, workers=None, verbose=False, skipIfPresent=False):
+        '''Adds several scores to the database, given a list of corpus file paths
+        (anything accepted by :func:`music21.corpus.parse`). 
+        
+        Parsing, adding :class:`Moment` objects, and extracting the music21 objects
+        are done in a pool of `workers` processes (by default one per CPU), and
+        the extracted scores are written to the database one at a time by this object
+        as they become available. Scores are added in the order they finish, 
+        not necessarily the order of `paths`. No more than twice as many scores as there 
+        are workers are extracted ahead of the writing, so a slow server doesn't leave 
+        every extracted score waiting in memory.
+        
+        Each worker process uses its own Database object with the default callbacks,
+        so callbacks added with :meth:`addPropertyCallback` are not used by this method.
+        
+        Returns a list of :class:`ImportStats` objects, one per score, named by path.
+        The `error` attribute of each is None unless the score failed to import, whether
+        it couldn't be extracted or couldn't be written; the other scores are still added. 
+        With the `verbose` argument set to `True` a summary is written to stderr 
+        as each score is finished.
+        
+        With the `skipIfPresent` argument set to `True`, scores that are already in the
+        database (see :meth:`addScore`) are skipped before they are parsed.
+        
+        >>> db = Database()
+        >>> db.wipeDatabase() # doctest: hide
+        >>> report = db.addScores(['bach/bwv84.5.mxl'], workers=2)
+        >>> print report[0].name, report[0].nodeCount, report[0].relationshipCount
+        bach/bwv84.5.mxl 456 1481
+        '''
+        import multiprocessing
+        if not workers:
+            workers = multiprocessing.cpu_count()
+        report = []
+        if skipIfPresent:
+            remaining = []
+            for path in paths:
+                if self.hasScore(getContentHash(path)):
+                    stats = ImportStats(path)
+                    stats.skipped = True
+                    report.append(stats)
+                    if verbose:
+                        sys.stderr.write('%s: already in the database\n' % path)
+                else:
+                    remaining.append(path)
+            paths = remaining
+        pool = multiprocessing.Pool(workers, _initImportWorker, (self.uri, self.dbargs))
+        finished = Queue.Queue()
+        pending = {}
+        queued = iter(enumerate(paths))
+        def submit():
+            # Keeps the workers busy without letting extracted scores pile up.
+            for key, path in queued:
+                pending[key] = (path, pool.apply_async(_extractScoreForImport, (path,), 
+                                                       callback=lambda result, key=key: finished.put((key, result))))
+                if len(pending) >= 2 * workers:
+                    break
+        try:
+            submit()
+            while pending:
+                try:
+                    key, (nodes, edges, contentHash, stats) = finished.get(timeout=1.0)
+                except Queue.Empty:
+                    # A task that raised instead of returning has no callback.
+                    for key, (path, result) in pending.items():
+                        if result.ready() and not result.successful():
+                            stats = ImportStats(path)
+                            try:
+                                result.get()
+                            except Exception as e:
+                                stats.error = '%s: %s' % (e.__class__.__name__, e)
+                            del pending[key]
+                            report.append(stats)
+                            if verbose:
+                                sys.stderr.write('%s: failed (%s)\n' % (stats.name, stats.error))
+                    submit()
+                    continue
+                del pending[key]
+                submit()
+                report.append(stats)
+                if not stats.error:
+                    try:
+                        self._prepareImport(False, stats, scoreId=contentHash)
+                        self.nodeFarm.importRows(nodes, edges)
+                        self.maxNodes = len(nodes)
+                        self.maxEdges = len(edges)
+                        del nodes, edges
+                        self._writeNodesToDatabase()
+                        self._writeEdgesToDatabase(None)
+                        self._storeContentHash(contentHash)
+                        stats.sqliteFlushes += self.nodeFarm.flushCount
+                    except Exception as e:
+                        stats.error = '%s: %s' % (e.__class__.__name__, e)
+                    finally:
+                        if self.nodeFarm:
+                            self.nodeFarm.close()
+                            self.nodeFarm = None
+                        self.importStats = None
+                if stats.error:
+                    if verbose:
+                        sys.stderr.write('%s: failed (%s)\n' % (stats.name, stats.error))
+                    continue
+                if verbose:
+                    extractTime = sum(stats.phases[x]['wall'] for x in ('moments', 'extraction'))
+                    writeTime = sum(stats.phases[x]['wall'] for x in ('nodeWrite', 'edgeWrite'))
+                    sys.stderr.write('%s: %d nodes, %d relationships; extracted in %.1f s, '
+                                     'written in %.1f s (%.0f nodes/s)\n'
+                                     % (stats.name, stats.nodeCount, stats.relationshipCount, extractTime,
+                                        writeTime, stats.nodeCount / max(writeTime, 0.001)))
+        finally:
+            pool.close()
+            pool.join()
+        return report
+
+    def exportImportFiles(self, scores, directory, verbose=False):
+        '''Writes a list of scores to CSV files for the Neo4j offline import tool
+        (`neo4j-import`), instead of adding them to the database. This is
+        much faster than :meth:`addScore` for the initial load of a large corpus,
+        and doesn't need a connection to the database server.
+        
+        Each item in `scores` can be either a music21 :class:`~music21.stream.Score` 
+        (which should already have :class:`Moment` objects) or a corpus file path,
+        which will be parsed and given Moments. The files are written to `directory`: 
+        a header file and a data file for each node type (`nodes_Note_header.csv` and 
+        `nodes_Note.csv`, etc.) and for each relationship type 
+        (`relationships_NoteInMeasure_header.csv`, etc.). Node IDs are numbered
+        consecutively across all the scores, and each node is also given its 
+        type as a label. 
+        
+        Returns a dict with keys for `nodes` and `relationships`, each a list of 
+        (header path, data path) tuples, and `nodeCount` and `relationshipCount`.
+        The files can be loaded into a new database with something like::
+        
+            $ bin/neo4j-import --into data/graph.db \\
+                --nodes nodes_Note_header.csv,nodes_Note.csv ... \\
+                --relationships relationships_NoteInMeasure_header.csv,relationships_NoteInMeasure.csv ...
+        
+        The offline import tool doesn't update the automatic indexes, so after loading
+        the `type` properties need to be set again for the auto-indexes to find them 
+        (`MATCH (n) SET n.type = n.type`, and likewise for relationships).
 
+        >>> import tempfile
         >>> db = Database()
-        >>> db.wipeDatabase()
-        >>> print db.graph_db.get_relationship_count()
-        0
-        >>> print db.graph_db.get_node_count()
-        1
-        >>> bwv84_5 = corpus.parse('bach/bwv84.5.mxl')  # doctest: hide
-        >>> addMomentsToScore(bwv84_5)                  # doctest: hide
-        >>> db.addScore(bwv84_5)                        # doctest: hide
-
-        The node count can never go below 1 because Neo4j always keeps a reference node 
-        in its network graph.
+        >>> files = db.exportImportFiles(['bach/bwv84.5.mxl'], tempfile.mkdtemp())
+        >>> print files['nodeCount'], files['relationshipCount']
+        456 1481
         '''
-        q = Query(self)
-        q.setStartRelationship()
-        rGen = q.results()
-        while True:
-            results = rGen.next(limit=100)
-            if not results:
-                break
-            results = [x[0] for x in results]
-            _serverCall(self.graph_db.delete, *results)
-        q = Query(self)
-        q.setStartNode()
-        rGen = q.results()
-        while True:
-            results = rGen.next(limit=100)
-            if not results:
-                break
-            results = [x[0] for x in results]
-            _serverCall(self.graph_db.delete, *results)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        batchSize = 1000
+        nodeFiles = {}
+        edgeFiles = {}
+        nextId = 0
+        edgeCount = 0
+        for score in scores:
+            if isinstance(score, basestring):
+                path = score
+                score = music21.corpus.parse(path)
+                addMomentsToScore(score)
+            self._prepareImport(False)
+            self._extractNodes(score)
+            rowsHash = self.nodeFarm.getContentHash()
+            contentHash = _fileContentHash(score) or rowsHash
+            self.nodeFarm.scoreId = contentHash
+            # Node IDs are assigned here rather than by the database.
+            nodeIds = {}
+            idx = 1
+            while True:
+                subset = self.nodeFarm.getNodeBatch(idx, batchSize)
+                if not subset:
+                    break
+                for row in subset:
+                    vertex = row['vertex']
+                    nodeType = vertex['type']
+                    if contentHash and row['parentHash'] is None:
+                        # The first node without a parent is the Score.
+                        vertex['contentHash'] = contentHash
+                        vertex['rowsHash'] = rowsHash
+                        contentHash = None
+                    if nodeType not in nodeFiles:
+                        nodeFiles[nodeType] = _BulkImportFile(directory, 'nodes', nodeType, (':ID', ':LABEL'))
+                    nodeFiles[nodeType].add([nextId, nodeType], vertex)
+                    nodeIds[row['hash']] = nextId
+                    nextId += 1
+                idx += len(subset)
+            idx = 1
+            while True:
+                subset = self.nodeFarm.getEdgeBatch(idx, batchSize)
+                if not subset:
+                    break
+                for edge in subset:
+                    relation = edge['relationship']
+                    if relation not in edgeFiles:
+                        edgeFiles[relation] = _BulkImportFile(directory, 'relationships', relation, 
+                                                              (':START_ID', ':END_ID', ':TYPE'))
+                    fixedValues = [nodeIds[edge['startNodeHash']], nodeIds[edge['endNodeHash']], relation]
+                    edgeFiles[relation].add(fixedValues, edge['properties'] or {})
+                edgeCount += len(subset)
+                idx += len(subset)
+            self.nodeFarm = None
+            if verbose:
+                sys.stderr.write('Exported %s (%d nodes, %d relationships so far)\n' 
+                                 % (getattr(score, 'corpusFilepath', score), nextId, edgeCount))
+        for f in nodeFiles.values() + edgeFiles.values():
+            f.finish()
+        return { 'nodes': [(f.headerPath, f.dataPath) for f in nodeFiles.values()],
+                 'relationships': [(f.headerPath, f.dataPath) for f in edgeFiles.values()],
+                 'nodeCount': nextId,
+                 'relationshipCount': edgeCount }
 
-    def addScore(self, score, verbose=False):
-        '''Adds a music21 :class:`~music21.stream.Score` to the database.
-        To see progress on the import, we can set the `verbose` argument to `True`.
+    def deleteScore(self, score, chunkSize=5000, verbose=False):
+        '''Removes a score's nodes and relationships from the database, given either its
+        `scoreId` (see :meth:`addScore`) or its corpus file path. 
+        All copies of the score with that ID or path are removed. Returns the number 
+        of nodes deleted.
         
-        In order to be able to access vertical note relationships such as
-        `NoteSimultaneousWithNote` and `MomentInNote`,
-        we need to add :class:`Moment` objects to the score using the 
-        module-level :meth:`addMomentsToScore` method before calling this method.
+        The nodes are found with the automatic index on `scoreId`, and are deleted 
+        on the server in chunks of no more than `chunkSize` nodes, 
+        each with its own transaction. 
+        Scores added before nodes were given a `scoreId` can't be removed this way.
+        
+        >>> db = Database()
+        >>> db.deleteScore('bach/bwv84.5.mxl')
+        456
+        >>> db.hasScore(getContentHash('bach/bwv84.5.mxl'))
+        False
+        >>> bwv84_5 = corpus.parse('bach/bwv84.5.mxl') # doctest: hide
+        >>> addMomentsToScore(bwv84_5)                 # doctest: hide
+        >>> stats = db.addScore(bwv84_5)               # doctest: hide
+        '''
+        query = py2neo.neo4j.CypherQuery(self.graph_db, 
+                    'START s=node:node_auto_index(type="Score") WHERE s.corpusFilepath = {path} '
+                    'RETURN DISTINCT s.scoreId;')
+        scoreIds = [x[0] for x in self._serverCall(query.stream, path=score) if x[0]]
+        if not scoreIds:
+            scoreIds = [score]
+        deleted = 0
+        self._bumpGeneration()
+        for scoreId in scoreIds:
+            # The catalog of the score is deleted by _removeFromCatalog, once it has been subtracted.
+            deleted += self._deleteInChunks('START n=node:node_auto_index(scoreId={scoreId}) '
+                                            'WHERE n.type <> "MusicNetScoreCatalog" ', 
+                                            chunkSize, verbose, scoreId=scoreId)
+        self._removeFromCatalog(scoreIds)
+        self._relationshipTypeCounts = None
+        self._bumpGeneration()
+        return deleted
+    
+    def replaceScore(self, score, verbose=False, **kwargs):
+        '''Removes any copies of a score with the same corpus file path or parsed from 
+        the same file from the database (see :meth:`deleteScore`), then adds the new version with :meth:`addScore`, 
+        which is also given any other keyword arguments. 
+        Returns the :class:`ImportStats` for the import.
         
         >>> db = Database()
-        >>> db.wipeDatabase() # doctest: hide
         >>> bwv84_5 = corpus.parse('bach/bwv84.5.mxl')
         >>> addMomentsToScore(bwv84_5)
-        >>> db.addScore(bwv84_5)
+        >>> stats = db.replaceScore(bwv84_5)
         >>> print db.graph_db.get_node_count()
-        457
-        >>> print db.graph_db.get_relationship_count()
-        1517
+        458
+        '''
+        path = getattr(score, 'corpusFilepath', None)
+        if path:
+            self.deleteScore(path, verbose=verbose)
+        contentHash = _fileContentHash(score)
+        if contentHash:
+            self.deleteScore(contentHash, verbose=verbose)
+        return self.addScore(score, verbose=verbose, **kwargs)
+    
+    def _deleteInChunks(self, match, chunkSize, verbose=False, **params):
+        '''Deletes the nodes found by the `match` clause (a START or MATCH clause binding `n`), 
+        along with their relationships, with repeated queries of no more than `chunkSize` nodes.
+        Returns the number of nodes deleted.
+        '''
+        query = py2neo.neo4j.CypherQuery(self.graph_db, match + 
+                    'WITH n LIMIT {chunkSize} '
+                    'OPTIONAL MATCH (n)-[r]-() '
+                    'WITH n, collect(r) AS rels '
+                    'FOREACH (r IN rels | DELETE r) '
+                    'DELETE n '
+                    'RETURN count(*);')
+        deleted = 0
+        start = time.time()
+        while True:
+            count = self._serverCall(query.execute_one, chunkSize=chunkSize, **params)
+            if not count:
+                break
+            deleted += count
+            if verbose:
+                elapsed = time.time() - start
+                sys.stderr.write('Deleted %d nodes in %.1f seconds (%.0f nodes/s)\n' 
+                                 % (deleted, elapsed, deleted / max(elapsed, 0.001)))
+        return deleted
+    
+    def hasScore(self, contentHash):
+        '''Returns `True` if a score with the given content hash (see :func:`getContentHash`)
+        has been added to the database.
+        
+        >>> db = Database()
+        >>> db.hasScore(getContentHash('bach/bwv84.5.mxl'))
+        True
         '''
-        self.nodeRefs = {}
+        query = py2neo.neo4j.CypherQuery(self.graph_db, 
+                    'START n=node:node_auto_index(contentHash={contentHash}) RETURN id(n) LIMIT 1;')
+        return self._serverCall(query.execute_one, contentHash=contentHash) is not None
+
+    def _prepareImport(self, verbose=False, stats=None, stagingFile=None, resume=False, scoreId=None):
         self.maxNodes = 0
         self.maxEdges = 0
-        self.nodeFarm = NodeFarm()
+        if stagingFile:
+            self.nodeFarm = NodeFarm(stagingFile, self.stagingCacheLimit, resume)
+        else:
+            self.nodeFarm = NodeFarm()
+        self.nodeFarm.scoreId = scoreId
+        self.importStats = stats or ImportStats()
         self._extractState = { 'verbose': verbose,
                               'nodeCnt': 0,
                               'relationCnt': 0,
                               'nodeLookup': {} }  # vertex, parent, voice
-        import copy
-        if verbose:
-            self.lastProgress = 0
-            self._timeUpdate(report=False)
-            self._extractState['partItemMax'] = sum([len(x) for x in score.parts])
-            sys.stderr.write('Extracting music21 objects..........')
-        self._extractNodes(score)        
-        self._writeNodesToDatabase()        
-        self._writeEdgesToDatabase(score)
-
-    def listScores(self): # start=0, limit=100):
+
+    def listScores(self, start=0, limit=None, composer=None, title=None, path=None, 
+                   sortBy='corpusFilepath', reverse=False):
         '''Returns a list of dict objects with information about the scores that have been added 
-        to the database, with keys for `movementName` and `_names` (a list of 
+        to the database, with keys for `movementName`, `corpusFilepath` and `_names` (a list of 
         contributor/composer names).
 
         >>> db = Database()
@@ -523,40 +2263,175 @@ class Database(object):
         >>> scores = db.listScores()
         >>> sorted(scores[0].items()) == expectedScore
         True
+        
+        The scores are ordered by `sortBy` (`corpusFilepath`, `movementName` or `composer`),
+        in reverse if `reverse` is `True`, and `limit` scores are returned starting from 
+        the `start` one. The `composer`, `title` and `path` arguments keep only the scores 
+        with a contributor name, movement name or corpus file path containing the given 
+        text, ignoring case.
+        
+        >>> [x['corpusFilepath'] for x in db.listScores(path='BWV84', limit=10)]
+        [u'bach/bwv84.5.mxl']
+        >>> db.listScores(title='no such title')
+        []
+        >>> db.listScores(start=1)
+        []
+        
+        The scores are listed from an index stored in the database by :meth:`addScore`, which 
+        is held in memory until the database changes, so a page is returned without a query 
+        to the server. If the database has scores added before the index was kept, 
+        the index is built with a query instead.
         '''
-        q = Query(self)
-        score = q.setStartNode(nodeType='Score')
-        inScore = q.addRelationship(relationType='MetadataInScore', end=score, optional=True)
-        meta = inScore.start
-        inMetadata = q.addRelationship(relationType='ContributorInMetaData', end=meta, optional=True)
-        contributor = inMetadata.start
-        q.addReturns(meta.movementName, contributor._names, score.corpusFilepath)
-        q.limitReturnToWhere = True
-        rGen = q.results(omitStart=True)
-        results = rGen.fetch_all()
-        meta = results[0]._fields
-        columns = [x[x.find('.') + 1:] for x in meta]
-        scores = {}
-        for row in results:
-            index = row[0] or row[2]
-            if index not in scores:
-                scores[index] = {}
-            for i in range(len(row)):
-                col = columns[i]
-                if col not in scores[index]:
-                    scores[index][col] = set()
-                scores[index][col].add(row[i])
-        for score in scores.itervalues():
-            for col in score:
-                if col == '_names':
-                    score[col] = list(score[col])
-                else:
-                    score[col] = score[col].pop()
-        return scores.values()
+        index = self._scoreIndex()
+        if sortBy not in index['orders']:
+            index['orders'][sortBy] = sorted(index['scores'], key=_scoreSortKey(sortBy))
+        scores = index['orders'][sortBy]
+        if reverse:
+            scores = scores[::-1]
+        filters = [(key, text.lower()) for key, text in (('_names', composer), ('movementName', title), 
+                                                         ('corpusFilepath', path)) if text]
+        if filters:
+            scores = [x for x in scores if all(self._scoreMatches(x[key], text) for key, text in filters)]
+        end = None if limit is None else start + limit
+        return [dict(x, _names=list(x['_names'])) for x in scores[start:end]]
+
+    @staticmethod
+    def _scoreMatches(val, text):
+        if isinstance(val, list):
+            return any(x is not None and text in unicode(x).lower() for x in val)
+        return val is not None and text in unicode(val).lower()
+
+    def _scoreIndex(self):
+        '''Returns the score index for :meth:`listScores`, reading it again if the generation
+        of the database has changed. The index is a dict with the entries of the `scores`, 
+        and the `orders` they have been sorted in so far.
+        '''
+        generation = self._currentGeneration()
+        if hasattr(self, 'scoreIndex') and self.scoreIndex['generation'] == generation:
+            return self.scoreIndex
+        query = py2neo.neo4j.CypherQuery(self.graph_db, 
+                    'START n=node:node_auto_index(type="MusicNetMetadata") RETURN n.scoreIndex;')
+        found = list(self._serverCall(query.stream))
+        if found and found[0][0]:
+            scores = json.loads(found[0][0]).values()
+        else:
+            # The catalog is only kept if every score was added with one, and so is the index.
+            scores = self._queryScoreIndex().values()
+        self.scoreIndex = { 'generation': generation, 'scores': scores, 'orders': {} }
+        return self.scoreIndex
+
+    def _queryScoreIndex(self):
+        # Builds the entries of the score index from the Score, Metadata and Contributor nodes,
+        # keyed by scoreId (or by node ID for scores added before nodes were given one).
+        query = py2neo.neo4j.CypherQuery(self.graph_db, 
+                    'START score=node:node_auto_index(type="Score") '
+                    'OPTIONAL MATCH (meta)-[:MetadataInScore]->(score) '
+                    'OPTIONAL MATCH (contributor)-[:ContributorInMetaData]->(meta) '
+                    'RETURN ID(score), score.scoreId, score.corpusFilepath, meta.movementName, '
+                    'collect(contributor._names);')
+        summaries = {}
+        for nodeId, scoreId, path, name, names in self._serverCall(query.stream):
+            key = scoreId or unicode(nodeId)
+            summary = summaries.setdefault(key, { 'corpusFilepath': path, 'movementName': None, '_names': [] })
+            summary['movementName'] = summary['movementName'] or name
+            summary['_names'].extend(x for x in names if x not in summary['_names'])
+        return dict((key, _scoreEntry(x)) for key, x in summaries.iteritems())
+
+    def rebuildCatalog(self, missingOnly=False, verbose=False):
+        '''Builds the catalog read by the `list` methods (see :meth:`listNodeTypes`), 
+        the catalog of each score and the score index (see :meth:`listScores`) from the
+        nodes and relationships in the database. Once it is built, :meth:`addScore` 
+        and :meth:`deleteScore` keep it up to date. The catalog of each score is kept in 
+        a node of type `MusicNetScoreCatalog`, apart from the catalog of the database.
+        
+        This is needed for a database whose scores were added before catalogs were kept,
+        or where a score was left behind by an import that failed before a catalog was 
+        started, since otherwise a catalog is only started for an empty database. 
+        It reads every node and relationship, so it takes about as long as reading the 
+        database, and scores should not be added or deleted while it runs. The nodes of
+        scores added before nodes were given a `scoreId` are counted in the catalog, 
+        but have no catalog of their own.
+        
+        With `missingOnly` set to `True`, nothing is done if the database already has 
+        a catalog. Returns `True` if the catalog was built. The `scripts/rebuild_catalog.py` 
+        script calls this method; the server doesn't, and only reads a stored catalog.
+        
+        >>> db = Database()
+        >>> db.rebuildCatalog()
+        True
+        >>> db.rebuildCatalog(missingOnly=True)
+        False
+        >>> print [x['count'] for x in db.listRelationshipTypes() if x['type']=='NoteSimultaneousWithNote']
+        [354]
+        '''
+        if missingOnly and self._loadCatalog() is not None:
+            return False
+        start = time.time()
+        # Makes sure there is a MusicNetMetadata node to hold the catalog.
+        self._bumpGeneration()
+        catalog = _Catalog(self.catalogValueLimit)
+        scoreCatalogs = {}
+        def addRows(kind, rows):
+            properties = self._serverCall(self.graph_db.get_properties, *[x[0] for x in rows])
+            for (entity, entityType, scoreId, ends), props in zip(rows, properties):
+                catalog.add(kind, entityType, props, ends)
+                if scoreId:
+                    if scoreId not in scoreCatalogs:
+                        scoreCatalogs[scoreId] = _Catalog(self.catalogValueLimit)
+                    scoreCatalogs[scoreId].add(kind, entityType, props, ends)
+        nodes = py2neo.neo4j.CypherQuery(self.graph_db, 
+                    'START n=node(*) WHERE NOT n.type IN ["MusicNetMetadata", "MusicNetScoreCatalog"] '
+                    'RETURN n, n.type, n.scoreId, null;')
+        relationships = py2neo.neo4j.CypherQuery(self.graph_db, 
+                    'START r=relationship(*) MATCH (a)-[r]->(b) '
+                    'RETURN r, TYPE(r), a.scoreId, [a.type, b.type];')
+        for kind, query in (('nodes', nodes), ('relationships', relationships)):
+            rows = []
+            for entity, entityType, scoreId, ends in self._serverCall(query.stream):
+                rows.append((entity, entityType, scoreId, tuple(ends) if ends else None))
+                if len(rows) >= 1000:
+                    addRows(kind, rows)
+                    rows = []
+            if rows:
+                addRows(kind, rows)
+        # The catalogs of the scores are replaced before the catalog of the database.
+        delete = py2neo.neo4j.CypherQuery(self.graph_db, 
+                    'START c=node:node_auto_index(type="MusicNetScoreCatalog") DELETE c;')
+        self._serverCall(delete.execute)
+        create = py2neo.neo4j.CypherQuery(self.graph_db, 'CREATE (c {sidecar});')
+        for scoreId, scoreCatalog in sorted(scoreCatalogs.iteritems()):
+            self._sendOnce(create.execute, sidecar={ 'type': 'MusicNetScoreCatalog', 'scoreId': scoreId,
+                                                     'catalog': scoreCatalog.toJSON() })
+        params = { 'catalog': catalog.toJSON(), 
+                   'scoreIndex': json.dumps(self._queryScoreIndex(), sort_keys=True) }
+        query = py2neo.neo4j.CypherQuery(self.graph_db, 
+                    'START n=node:node_auto_index(type="MusicNetMetadata") RETURN n, n.catalogVersion;')
+        while True:
+            node, version = list(self._serverCall(query.stream))[0]
+            # Catalogs of scores kept on this node by earlier versions are removed.
+            removeStr = ''.join([' REMOVE n.%s' % _cypherName(x) 
+                                 for x in self._serverCall(node.get_properties)
+                                 if x.startswith('catalog_')])
+            if self._writeCatalog(version, 'n.catalog = {catalog}, n.scoreIndex = {scoreIndex}', 
+                                  removeStr, **params):
+                break
+        self._relationshipTypeCounts = None
+        self._forgetSchema()
+        if verbose:
+            sys.stderr.write('Built the catalog of %d scores in %.1f seconds\n' 
+                             % (len(scoreCatalogs), time.time() - start))
+        return True
 
     def listNodeTypes(self):
         '''Returns a set of node types available in the database.
         
+        This and the other `list` methods read a catalog of the database that 
+        :meth:`addScore` and :meth:`addScores` keep up to date, so they don't depend on
+        the size of the database. If the database has no catalog (because its scores 
+        were added before catalogs were kept) the information is found by querying 
+        the database, which is much slower and only samples the property values, 
+        until a catalog is built with :meth:`rebuildCatalog`.
+        
         >>> db = Database()
         >>> nTypes = db.listNodeTypes()
         >>> print 'Instrument' in nTypes
@@ -564,6 +2439,10 @@ class Database(object):
         '''
         if hasattr(self, 'nTypes'):
             return self.nTypes
+        catalog = self._loadCatalog()
+        if catalog:
+            self.nTypes = set(catalog.counts('nodes'))
+            return self.nTypes
         self.listRelationshipTypes()
         return self.nTypes
 
@@ -576,10 +2455,14 @@ class Database(object):
         >>> db = Database()
         >>> props = db.listNodeProperties()
         >>> print sorted( [x for x in props if x[0]=='Score'] )
-        [(u'Score', u'_atSoundingPitch'), (u'Score', u'_priority'), (u'Score', u'corpusFilepath'), (u'Score', u'hideObjectOnPrint'), (u'Score', u'offset')]
+        [(u'Score', u'_atSoundingPitch'), (u'Score', u'_priority'), (u'Score', u'contentHash'), (u'Score', u'corpusFilepath'), (u'Score', u'hideObjectOnPrint'), (u'Score', u'offset'), (u'Score', u'rowsHash')]
         '''
         if hasattr(self, 'nodeProperties'):
             return self.nodeProperties
+        catalog = self._loadCatalog()
+        if catalog:
+            self.nodeProperties, self.nodePropertyValues = catalog.properties('nodes')
+            return self.nodeProperties
         if not hasattr(self, 'nTypes'):
             self.listNodeTypes()
         self.nodeProperties = []
@@ -591,11 +2474,11 @@ class Database(object):
             rGen = q.results(limit=1000, omitStart=True)
             results = rGen.fetch_all()
             results = [x[0] for x in results]
-            nodes = _serverCall(self.graph_db.get_properties, *results)
+            nodes = self._serverCall(self.graph_db.get_properties, *results)
             properties = {}
             for node in nodes:
                 for prop in node:
-                    if prop == 'type':
+                    if prop in ('type', 'scoreId'):
                         continue
                     try:
                         propSet = properties[prop]
@@ -625,9 +2508,10 @@ class Database(object):
         self.listNodeProperties()
         return self.nodePropertyValues                
     
-    def listRelationshipTypes(self):
+    def listRelationshipTypes(self, refresh=False):
         '''Returns a list of relationship types in the database, represented as 
-        dict objects with keys for `start`, `type`, and `end`. By convention,
+        dict objects with keys for `start`, `type`, and `end`, and the number of
+        relationships of that kind (`count`). By convention,
         starts and ends in relationships read as a right-directed arrow::
         
             Start--Relationship-->End
@@ -639,34 +2523,63 @@ class Database(object):
         >>> rTypes = db.listRelationshipTypes()
         >>> print [x['type'] for x in rTypes if x['type']=='MetadataInScore']
         [u'MetadataInScore']
+        >>> print [x['count'] for x in rTypes if x['type']=='NoteSimultaneousWithNote']
+        [354]
+        
+        The list is kept until the database is changed by this object, or `refresh` is `True`.
+        If the database has no catalog (see :meth:`listNodeTypes`), the relationships are
+        counted with a single query, and afterwards the counts are updated with the 
+        relationships of each score added by this object, without counting again.
+        `refresh` can also be a list of relationship types, such as those of scores
+        changed by another process, in which case only relationships of those types are 
+        counted again.
+        
+        >>> counts = db.listRelationshipTypes(refresh=['NoteSimultaneousWithNote'])
+        >>> print [x['count'] for x in counts if x['type']=='NoteSimultaneousWithNote']
+        [354]
         '''
+        if refresh:
+            self._forgetSchema()
+            if refresh is True:
+                self._relationshipTypeCounts = None
+            elif self._relationshipTypeCounts is not None:
+                self._recountRelationshipTypes(refresh)
         if hasattr(self, 'rTypes'):
             return self.rTypes
+        catalog = self._loadCatalog()
+        if catalog:
+            self.rTypes = catalog.relationshipTypes()
+            self.nTypes = set(catalog.counts('nodes'))
+            return self.rTypes
+        counts = self._relationshipTypeCounts
+        if counts is None:
+            query = py2neo.neo4j.CypherQuery(self.graph_db, 
+                        'START r=relationship(*) MATCH (a)-[r]->(b) '
+                        'RETURN a.type, TYPE(r), b.type, count(*);')
+            counts = {}
+            for start, rType, end, count in self._serverCall(query.stream):
+                counts[(start, rType, end)] = count
+            self._relationshipTypeCounts = counts
         self.rTypes = []
         self.nTypes = set()
-        rTypes = set()
-        relateTypes = []
-        while not relateTypes:
-            queryText = 'START r=relationship(*) RETURN DISTINCT TYPE(r);'
-            rGen = Results(queryText)
-            rGen.start()
-            relateTypes = rGen.fetch_all()
-            #relateTypes, metadata = _cypherQuery(self.graph_db, queryText)
-        for relateType in relateTypes:
-            q = Query(self)
-            r = q.setStartRelationship(relationType=str(relateType[0]))
-            q.addReturns(r.start.type, r.end.type)
-            q.limitReturnToWhere = True;
-            rGen = q.results(limit=100, omitStart=True)
-            results = rGen.fetch_all()
-            for n1, n2 in results:
-                rTypes.add((n1, relateType[0], n2))
-                self.nTypes.add(n1)
-                self.nTypes.add(n2)
-        for start, r, end in rTypes:
-            self.rTypes.append({ 'start': start, 'type': r, 'end': end })
+        for (start, rType, end), count in sorted(counts.iteritems()):
+            self.rTypes.append({ 'start': start, 'type': rType, 'end': end, 'count': count })
+            self.nTypes.add(start)
+            self.nTypes.add(end)
         return self.rTypes
     
+    def _recountRelationshipTypes(self, rTypes):
+        # Replaces the counts of the given relationship types, one indexed query per type.
+        counts = self._relationshipTypeCounts
+        query = py2neo.neo4j.CypherQuery(self.graph_db, 
+                    'START r=relationship:relationship_auto_index(type={rType}) MATCH (a)-[r]->(b) '
+                    'RETURN a.type, TYPE(r), b.type, count(*);')
+        for rType in rTypes:
+            for key in [x for x in counts if x[1] == rType]:
+                del counts[key]
+            for start, found, end, count in self._serverCall(query.stream, rType=rType):
+                counts[(start, found, end)] = count
+    
     def listRelationshipProperties(self):
         '''Returns a list of relationship properties in the database, represented as tuples
          (relationship type,  property name).
@@ -681,6 +2594,10 @@ class Database(object):
         '''
         if hasattr(self, 'relateProperties'):
             return self.relateProperties
+        catalog = self._loadCatalog()
+        if catalog:
+            self.relateProperties, self.relatePropertyValues = catalog.properties('relationships')
+            return self.relateProperties
         rTypes = set()
         for x in self.listRelationshipTypes():
             rTypes.add(x['type']) 
@@ -693,11 +2610,11 @@ class Database(object):
             rGen = q.results(limit=1000, omitStart=True)
             results = rGen.fetch_all()
             results = [x[0] for x in results]
-            nodes = _serverCall(self.graph_db.get_properties, *results)
+            nodes = self._serverCall(self.graph_db.get_properties, *results)
             properties = {}
             for relate in nodes:
                 for prop in relate:
-                    if prop == 'type':
+                    if prop in ('type', 'scoreId'):
                         continue
                     try:
                         propSet = properties[prop]
@@ -726,6 +2643,16 @@ class Database(object):
             return self.relatePropertyValues
         self.listRelationshipProperties()
         return self.relatePropertyValues                
+
+    def _queryCatalog(self):
+        '''Returns the catalog used by :meth:`Query._chooseAnchor` to estimate the cost of
+        a query, or None if the database doesn't have one. The catalog is read again when 
+        the generation of the database changes.
+        '''
+        generation = self._currentGeneration()
+        if not hasattr(self, 'queryCatalog') or self.queryCatalog[0] != generation:
+            self.queryCatalog = (generation, self._loadCatalog())
+        return self.queryCatalog[1]
     
     def addPropertyCallback(self, entity, callback):
         '''**For advanced use only.**
@@ -743,6 +2670,7 @@ class Database(object):
         if entity not in self._callbacks:
             self._callbacks[entity] = []
         self._callbacks[entity].append(callback)
+        self._callbackDispatch = {}
 
     def _defaultCallbacks(self):
         HIDEFROMDATABASE = self.HIDEFROMDATABASE
@@ -758,6 +2686,22 @@ class Database(object):
                     self.nodeFarm.addNode(obj, score, partVertex)
         self.addPropertyCallback('Score', addNumbersToParts)
         
+        def addSimultaneousNotes(db, score, scoreVertex, emptyNode):
+            # Moments mark a score for vertical relationships, but the pairs are found 
+            # for the whole score at once so that each pair is only added once.
+            for el in score:
+                if isinstance(el, Moment):
+                    break
+            else:
+                return
+            notes, starts, ends, cInts, sInts, sameOffsets = getSimultaneousNotePairs(score)
+            for i in range(len(starts)):
+                properties = { 'harmonicInterval': cInts[i],
+                               'simpleHarmonicInterval': sInts[i],
+                               'sameOffset': sameOffsets[i] }
+                db._addEdge(notes[starts[i]], 'NoteSimultaneousWithNote', notes[ends[i]], properties)
+        self.addPropertyCallback('Score', addSimultaneousNotes)
+        
         # Contributor
         def addTextToContributor(db, contributor, vertex, metadataNode):
             vertex['_names'] = unicode(contributor.name)
@@ -925,27 +2869,7 @@ class Database(object):
             sameOffset = list(moment.sameOffset)
             for noteObj in sameOffset:
                 db._addEdge(noteObj, 'MomentInNote', moment, { 'startMoment': True })
-            notes = sameOffset + simultaneous
-            simuls = {}
-            for i in range(len(notes) - 1):
-                note1 = notes[i]
-                for j in range(i + 1, len(notes)):
-                    note2 = notes[j]
-                    if note1 in simuls:
-                        if note2 in simuls[note1]: continue
-                    else:
-                        simuls[note1] = {}
-                    if note2 in simuls and note1 in simuls[note2]:
-                        continue
-                    simuls[note1][note2] = True
-                    cInt = note1.midi - note2.midi
-                    sInt = _signedModulo(note1.midi - note2.midi, 12)
-                    properties = { 'harmonicInterval': cInt,
-                                   'simpleHarmonicInterval': sInt,
-                                   'sameOffset': 'False' }
-                    if note1.offset == note2.offset:
-                        properties['sameOffset'] = 'True'
-                    db._addEdge(note1, 'NoteSimultaneousWithNote', note2, properties)
+            # NoteSimultaneousWithNote relationships are added by the Score callback.
         self.addPropertyCallback('Moment', addCrossPartRelationships)
         
         # Spanner
@@ -1018,11 +2942,292 @@ class Database(object):
                 lookup[cName] = sName
         return lookup
 
-    def _timeUpdate(self, report=True):
-        newtime = time.time()
-        if report:
-            sys.stderr.write('(%.1f seconds)\n' % (newtime - self.refTime))
-        self.refTime = newtime
+    def _endPhase(self, phase):
+        elapsed = self.importStats.endPhase(phase)
+        if self._extractState['verbose']:
+            sys.stderr.write('(%.1f seconds)\n' % elapsed)
+    
+    def _serverCall(self, func, *args, **kwargs):
+        return _retryServerCall(func, args, kwargs, self._countServerCall)
+    
+    def _countServerCall(self):
+        if self.importStats:
+            self.importStats.serverCalls += 1
+    
+    def _sendOnce(self, func, *args, **kwargs):
+        '''Calls a py2neo function that writes to the database, without a retry: if the 
+        connection fails, the server may have run it anyway, and running it again would 
+        duplicate what it wrote. An import that fails can be finished with `resume`.
+        '''
+        self._countServerCall()
+        return func(*args, **kwargs)
+    
+    def _storeContentHash(self, contentHash=None):
+        '''Marks the score as completely imported by adding its content hash to its Score node,
+        and adds it to the catalog.
+        '''
+        contentHash = contentHash or self._extractState.get('contentHash')
+        rowsHash = self._extractState.get('rowsHash') or self.nodeFarm.getContentHash()
+        self._extractState['rowsHash'] = rowsHash
+        scoreRef = self.nodeFarm.getRootNodeRef()
+        if contentHash and scoreRef is not None:
+            query = py2neo.neo4j.CypherQuery(self.graph_db, 
+                        'START n=node({scoreRef}) SET n.contentHash = {contentHash}, n.rowsHash = {rowsHash};')
+            self._serverCall(query.execute, scoreRef=scoreRef, contentHash=contentHash, rowsHash=rowsHash)
+        self._updateCatalog(contentHash)
+        self._bumpGeneration()
+
+    def _updateCatalog(self, scoreId):
+        '''Adds the staged score to the catalog stored in the MusicNetMetadata node. 
+        The catalog of the score is also stored, in a node of type `MusicNetScoreCatalog` 
+        with the score's `scoreId`, so the catalog can be updated when scores are deleted. 
+        The node is created by the same statement that writes the catalog. While the 
+        catalog is kept, the score index (see :meth:`listScores`) is kept in the `scoreIndex` 
+        property, apart from the catalog so it can be read on its own.
+        '''
+        stats = self.importStats
+        stats.startPhase('catalog')
+        scoreCatalog = self.nodeFarm.getCatalog(self.catalogValueLimit)
+        if scoreId:
+            scoreCatalog.add('nodes', 'Score', { 'contentHash': scoreId, 
+                                                 'rowsHash': self._extractState.get('rowsHash') }, count=0)
+        if self._relationshipTypeCounts is not None:
+            # Add the new relationships to the counts of listRelationshipTypes.
+            counts = self._relationshipTypeCounts
+            for triple in scoreCatalog.relationshipTypes():
+                key = (triple['start'], triple['type'], triple['end'])
+                counts[key] = counts.get(key, 0) + triple['count']
+        scoreEntry = self.nodeFarm.getScoreSummary()
+        sidecar = { 'type': 'MusicNetScoreCatalog', 'catalog': scoreCatalog.toJSON() }
+        if scoreId:
+            sidecar['scoreId'] = scoreId
+        query = py2neo.neo4j.CypherQuery(self.graph_db, 
+                    'START n=node:node_auto_index(type="MusicNetMetadata") '
+                    'RETURN n.catalog, n.catalogVersion, n.scoreIndex;')
+        while True:
+            previous = list(self._serverCall(query.stream))
+            if not previous:
+                break
+            catalogText, version, indexText = previous[0]
+            if catalogText:
+                catalog = _Catalog.fromJSON(catalogText)
+            elif self._countScores() <= scoreCatalog.counts('nodes').get('Score', 0):
+                # Only start a catalog if this score is all the database holds.
+                catalog = _Catalog(self.catalogValueLimit)
+            else:
+                self._catalogMissing()
+                break
+            catalog.merge(scoreCatalog)
+            index = json.loads(indexText) if indexText else {}
+            index[scoreId] = scoreEntry
+            if self._writeCatalog(version, 'n.catalog = {catalog}, n.scoreIndex = {scoreIndex}', 
+                                  createStr=' CREATE (c {sidecar})', catalog=catalog.toJSON(), 
+                                  scoreIndex=json.dumps(index, sort_keys=True), sidecar=sidecar):
+                break
+        self._forgetSchema()
+        stats.endPhase('catalog')
+
+    def _removeFromCatalog(self, scoreIds):
+        '''Subtracts the catalogs of deleted scores from the catalog of the database, removes
+        their entries from the score index, and then deletes their MusicNetScoreCatalog nodes. 
+        A score no longer in the index was subtracted by an earlier attempt, and isn't
+        subtracted again. The catalog is only rebuilt from the catalogs of the remaining 
+        scores if it has dropped values the deleted scores used.
+        '''
+        lookup = _scoreCatalogLookup(scoreIds)
+        query = py2neo.neo4j.CypherQuery(self.graph_db, 
+                    'START n=node:node_auto_index(type="MusicNetMetadata") '
+                    'RETURN n.catalog, n.catalogVersion, n.scoreIndex;')
+        catalogs = py2neo.neo4j.CypherQuery(self.graph_db, 
+                    'START c=node:node_auto_index({lookup}) RETURN c.scoreId, c.catalog;')
+        while True:
+            found = list(self._serverCall(query.stream))
+            if not found or not found[0][0]:
+                break
+            catalogText, version, indexText = found[0]
+            catalog = _Catalog.fromJSON(catalogText)
+            index = json.loads(indexText) if indexText else {}
+            exact = True
+            for scoreId, text in self._serverCall(catalogs.stream, lookup=lookup):
+                if scoreId in index:
+                    exact = catalog.subtract(_Catalog.fromJSON(text)) and exact
+            if not exact:
+                catalog = self._mergeScoreCatalogs(scoreIds)
+            for scoreId in scoreIds:
+                index.pop(scoreId, None)
+            if self._writeCatalog(version, 'n.catalog = {catalog}, n.scoreIndex = {scoreIndex}', 
+                                  catalog=catalog.toJSON(), scoreIndex=json.dumps(index, sort_keys=True)):
+                break
+        delete = py2neo.neo4j.CypherQuery(self.graph_db, 'START c=node:node_auto_index({lookup}) DELETE c;')
+        self._serverCall(delete.execute, lookup=lookup)
+        self._forgetSchema()
+
+    def _mergeScoreCatalogs(self, removed=()):
+        # Merges the catalogs of the scores in the database, leaving out the `removed` scoreIds.
+        query = py2neo.neo4j.CypherQuery(self.graph_db, 
+                    'START c=node:node_auto_index(type="MusicNetScoreCatalog") RETURN c.scoreId, c.catalog;')
+        catalog = _Catalog(self.catalogValueLimit)
+        for scoreId, text in self._serverCall(query.stream):
+            if scoreId not in removed:
+                catalog.merge(_Catalog.fromJSON(text))
+        return catalog
+
+    def _writeCatalog(self, version, setStr, removeStr='', createStr='', **params):
+        '''Sets and removes properties of the MusicNetMetadata node if its `catalogVersion` 
+        is still `version`, and moves it on to the next version. The `createStr` clause is
+        run by the same statement, so only if the catalog is written. Returns False if another 
+        process changed the catalog first, in which case it should be read and changed again.
+        
+        The write is marked with a random `catalogWrite` token. If a retry after a lost 
+        response finds the version moved on, the token shows whether it was this write 
+        that moved it, so the change isn't made twice.
+        '''
+        version = version or 0
+        token = '%016x' % random.getrandbits(64)
+        query = py2neo.neo4j.CypherQuery(self.graph_db, 
+                    'START n=node:node_auto_index(type="MusicNetMetadata") '
+                    'WHERE coalesce(n.catalogVersion, 0) = {version} '
+                    'SET n.catalogVersion = {version} + 1, n.catalogWrite = {token}%s%s%s RETURN count(n);' 
+                    % (', ' + setStr if setStr else '', removeStr, createStr))
+        if self._serverCall(query.execute_one, version=version, token=token, **params) > 0:
+            return True
+        check = py2neo.neo4j.CypherQuery(self.graph_db, 
+                    'START n=node:node_auto_index(type="MusicNetMetadata") '
+                    'RETURN n.catalogVersion, n.catalogWrite;')
+        found = list(self._serverCall(check.stream))
+        return bool(found) and tuple(found[0]) == (version + 1, token)
+
+    def _countScores(self):
+        query = py2neo.neo4j.CypherQuery(self.graph_db, 
+                    'START s=node:node_auto_index(type="Score") RETURN count(s);')
+        return self._serverCall(query.execute_one)
+
+    def _loadCatalog(self):
+        '''Returns the catalog stored in the database, or None if there isn't one (because
+        the database is empty, or its scores were added before catalogs were kept).
+        '''
+        query = py2neo.neo4j.CypherQuery(self.graph_db, 
+                    'START n=node:node_auto_index(type="MusicNetMetadata") RETURN n.catalog;')
+        found = list(self._serverCall(query.stream))
+        if not found or not found[0][0]:
+            self._catalogMissing()
+            return None
+        return _Catalog.fromJSON(found[0][0])
+
+    def _catalogMissing(self):
+        # Suggests rebuildCatalog once, if the database has scores but no catalog.
+        if self._catalogHinted:
+            return
+        self._catalogHinted = True
+        if self._countScores():
+            sys.stderr.write('The database has no catalog, so listing its contents is slow. '
+                             'Run Database.rebuildCatalog() once to build it.\n')
+
+    def _forgetSchema(self):
+        # Drop the cached results of the list* methods.
+        for attr in ('nTypes', 'rTypes', 'nodeProperties', 'nodePropertyValues', 'relateProperties',
+                     'relatePropertyValues', 'queryCatalog', 'scoreIndex'):
+            if attr in self.__dict__:
+                delattr(self, attr)
+
+    def cacheStats(self):
+        '''Returns a dict of statistics about the cache of query results: the number of 
+        `hits` and `misses`, the number of results removed to make room for others
+        (`evictions`), and the number of results (`entries`) and estimated `bytes` it holds.
+        
+        Results are cached by the text and parameters of the query along with the 
+        generation of the database, which is stored in a node of type `MusicNetMetadata`
+        and changes whenever scores are added or deleted. Changes made by this object
+        are seen at once; changes made by other processes are seen within 
+        :attr:`generationCheckSeconds`.
+        
+        >>> db = Database()
+        >>> q = Query(db)
+        >>> s = q.setStartNode(nodeType='Score')
+        >>> first = q.results().fetch_all()
+        >>> second = q.results().fetch_all()
+        >>> first == second
+        True
+        >>> db.cacheStats()['hits'] >= 1
+        True
+        '''
+        if self.resultCache is None:
+            return {}
+        return self.resultCache.stats()
+
+    def _results(self, pattern, params=None, cursor=None, cache=True):
+        '''Starts and returns a :class:`Results` object for a query, which takes its rows 
+        from the result cache if the same query has been run in the current generation.
+        '''
+        if not cache or self.resultCache is None:
+            r = Results(pattern, params, db=self, cursor=cursor)
+        else:
+            key = (pattern, repr(sorted((params or {}).items())), self._currentGeneration())
+            rows = self.resultCache.get(key)
+            r = Results(pattern, params, db=self, cursor=cursor, rows=rows, 
+                        cache=self.resultCache, cacheKey=key)
+        r.start()
+        return r
+
+    def _currentGeneration(self):
+        '''Returns the generation of the database, reading it from the server if it hasn't 
+        been read or changed in the last :attr:`generationCheckSeconds`.
+        '''
+        now = time.time()
+        if self._generationChecked and now - self._generationChecked < self.generationCheckSeconds:
+            return self._generation
+        query = py2neo.neo4j.CypherQuery(self.graph_db, 
+                    'START n=node:node_auto_index(type="MusicNetMetadata") RETURN max(n.generation);')
+        self._generation = self._serverCall(query.execute_one)
+        self._generationChecked = now
+        return self._generation
+
+    def _bumpGeneration(self):
+        '''Changes the generation of the database, so that cached query results are not reused.
+        A new generation starts from the current time in microseconds, so it can't match
+        one from before the database was wiped.
+        '''
+        query = py2neo.neo4j.CypherQuery(self.graph_db, 
+                    'START n=node:node_auto_index(type="MusicNetMetadata") '
+                    'SET n.generation = n.generation + 1 RETURN n.generation;')
+        generation = self._serverCall(query.execute_one)
+        if generation is None:
+            # The node is created through a unique index, so two processes (or a request whose 
+            # response was lost) can't create two of them. It is sent once all the same.
+            properties = { 'type': 'MusicNetMetadata', 'generation': int(time.time() * 1000000) }
+            node = self._sendOnce(self.graph_db.get_or_create_indexed_node, 
+                                  'musicNetMetadata', 'type', 'MusicNetMetadata', properties)
+            generation = self._serverCall(node.get_properties)['generation']
+        self._generation = generation
+        self._generationChecked = time.time()
+
+    def _dropGeneration(self):
+        # An empty database has no generation.
+        query = py2neo.neo4j.CypherQuery(self.graph_db, 
+                    'START n=node:node_auto_index(type="MusicNetMetadata") DELETE n;')
+        self._serverCall(query.execute)
+        self._generation = None
+        self._generationChecked = time.time()
+    
+    def _createInBatches(self, entities, sizer):
+        '''Creates nodes or relationships with a single request, timing it for the `sizer`. 
+        If the server rejects the request, the batch is split in half and each half is retried 
+        after a delay. Other errors are raised without a retry: the server may have written 
+        the batch before the request failed, and creating it again would duplicate it.
+        '''
+        start = time.time()
+        try:
+            self._countServerCall()
+            results = self.graph_db.create(*entities)
+        except _BATCH_ERRORS:
+            if len(entities) == 1:
+                raise
+            time.sleep(sizer.failed(len(entities)))
+            half = len(entities) / 2
+            return (self._createInBatches(entities[:half], sizer) + 
+                    self._createInBatches(entities[half:], sizer))
+        sizer.succeeded(len(entities), time.time() - start)
+        return list(results)
 
     def _progressReport(self, state, minIn, maxIn, minOut, maxOut):
         if not hasattr(self, 'lastProgress'):
@@ -1105,22 +3310,34 @@ class Database(object):
         self.maxEdges = self.maxEdges + 1
            
     def _runCallbacks(self, node, nodeData, parentData):
-        keys = self._callbacks.keys()
+        try:
+            callbacks = self._callbackDispatch[node.__class__]
+        except KeyError:
+            callbacks = self._callbackDispatch[node.__class__] = self._resolveCallbacks(node)
+        stats = self.importStats
+        for callback in callbacks:
+            start = time.time()
+            rc = callback(self, node, nodeData, parentData)
+            stats._addCallbackTime(callback.__name__, time.time() - start)
+            if rc != None:
+                return rc
+
+    def _resolveCallbacks(self, node):
+        '''Returns the ordered list of callbacks for an object. The list only depends 
+        on the object's class, so it is cached by :meth:`_runCallbacks`.
+        '''
         if hasattr(node, 'classes'):
-            kinds = [x for x in node.classes if x in keys]
+            kinds = [x for x in node.classes if x in self._callbacks]
         else:
             name = node.__class__.__name__
             try: 
                 kinds = [name, self._m21SuperclassLookup[name]]
             except KeyError:
                 kinds = [name]
+        callbacks = []
         for kind in kinds:
-            if kind not in self._callbacks:
-                continue
-            for callback in self._callbacks[kind]:
-                rc = callback(self, node, nodeData, parentData)
-                if rc != None:
-                    return rc
+            callbacks.extend(self._callbacks.get(kind, []))
+        return callbacks
 
     # get data from object; extract subnodes if necessary
     def _extractObject(self, obj, objData=None, parentNode=None):
@@ -1134,104 +3351,247 @@ class Database(object):
             self.maxNodes = self.maxNodes + 1
         objectDict = obj.__dict__
         vertex = objData['vertex']
+        rules = self._propertyRules
+        valueKinds = self._valueKinds
         for key, val in objectDict.iteritems():
-            if key in self._skipProperties:
-                continue
-            if val == None and key in ('_duration'):
+            try:
+                rule = rules[key]
+            except KeyError:
+                rule = self._compileProperty(key)
+            if rule is None:
                 continue
-            elif isinstance(val, list):
+            try:
+                kind = valueKinds[val.__class__]
+            except KeyError:
+                kind = valueKinds[val.__class__] = self._valueKind(val)
+            if kind == 'property':
+                name, skipIfNone = rule
+                if val is None and skipIfNone:
+                    continue
+                if name not in vertex:
+                    vertex[name] = val
+            elif kind == 'child':
+                self._extractNodes(val, objData)
+            elif kind == 'list':
                 for item in val:
                     if hasattr(item, '__dict__'):
                         self._extractNodes(item, objData)
-                continue
-            elif isinstance(val, dict):
-                for key, text in val.iteritems():
-                    if key not in vertex:
-                        vertex[key] = str(text)
-                continue
-            elif isinstance(val, music21.musicxml.mxObjects.MusicXMLElement):
-                continue
-            elif hasattr(val, '__dict__'):
-                self._extractNodes(val, objData)
-                continue
-            if key == 'type':
-                key = 'm21_' + key
-            if key not in vertex:
-                vertex[key] = val
-        for key, val in vertex.items():
-            if not isinstance(val, (int, float, long)):
-                val = unicode(val)
-            if key not in vertex:
-                vertex[key] = val
+            elif kind == 'dict':
+                for textKey, text in val.iteritems():
+                    if textKey not in vertex:
+                        vertex[textKey] = str(text)
         self.nodeFarm.updateNode(objData, 'vertex', vertex)
         return objData
     
+    def _compileProperty(self, key):
+        '''Returns the extraction rule for an attribute name the first time any object
+        with that attribute is extracted, and keeps it for :meth:`_extractObject`: either 
+        None (the attribute is skipped) or a tuple of the property name and whether 
+        a None value is skipped.
+        '''
+        rule = None
+        if key not in self._skipProperties:
+            name = key
+            if key == 'type':
+                name = 'm21_' + key
+            # A substring test, as in the original `key in ('_duration')`: None values
+            # are skipped for `_duration` and any attribute whose name is part of it.
+            rule = (name, key in '_duration')
+        self._propertyRules[key] = rule
+        return rule
+    
+    def _valueKind(self, val):
+        '''Returns how values of this type are extracted: as child nodes (`child`),
+        lists of child nodes (`list`), text properties (`dict`), plain properties
+        (`property`), or not at all (`skip`). The kind is cached for each type.
+        '''
+        if isinstance(val, list):
+            return 'list'
+        elif isinstance(val, dict):
+            return 'dict'
+        elif isinstance(val, music21.musicxml.mxObjects.MusicXMLElement):
+            return 'skip'
+        elif hasattr(val, '__dict__'):
+            return 'child'
+        return 'property'
+    
     def _writeNodesToDatabase(self):
         '''
         When nodes are written to the database in order, 
         references to their database entries will be returned in the same order.
-        Those references are saved as attributes in the original nodes.
+        The IDs of those entries are saved with the staged nodes.
         '''
-        batchSize = 100
+        sizer = self._nodeBatchSizer
+        stats = self.importStats
         verbose = self._extractState['verbose']
+        self._bumpGeneration()
         if verbose:
-            self._timeUpdate()
             sys.stderr.write('Writing nodes to database...........')
-        idx = 1
+        stats.startPhase('nodeWrite')
+        if self.useTransactions:
+            self._writeNodesInTransactions()
+            self._endPhase('nodeWrite')
+            return
+        idx = self.nodeFarm.getJournal('nodes') + 1
         self._refreshGraphDB()
         while True:
-            subset = self.nodeFarm.getNodeBatch(idx, batchSize)
+            subset = self.nodeFarm.getNodeBatch(idx, sizer.size)
             batchLen = len(subset)
             if batchLen == 0:
                 break
             vertices = [x['vertex'] for x in subset]
-            results = _serverCall(self.graph_db.create, *vertices)
-            # Store a nodeRef reference for each music21 object 
-            # with the address of its corresponding Neo4j node.
-            for i in range(len(results)):
-                self.nodeRefs[subset[i]['hash']] = results[i]
+            results = self._createInBatches(vertices, sizer)
+            for vertex in vertices:
+                stats._count(stats.nodeCounts, vertex['type'])
+            # Store a nodeRef for each music21 object 
+            # with the ID of its corresponding Neo4j node.
+            self.nodeFarm.setNodeRefs([(subset[i]['hash'], results[i]._id) for i in range(len(results))])
             self._extractState['nodeCnt'] += len(results)
             idx += len(results)
+            self.nodeFarm.setJournal('nodes', idx - 1)
             if verbose:
                 self._progressReport(idx, 0, self.maxNodes, 5, 25)
+        self._endPhase('nodeWrite')
         
     def _writeEdgesToDatabase(self, score):
         '''
         Before relationships are written to the database, music21 object references are converted 
         to their corresponding database nodes.
         '''
-        batchSize = 100
+        sizer = self._edgeBatchSizer
+        stats = self.importStats
         verbose = self._extractState['verbose']
         if verbose:
-            self._timeUpdate()
             sys.stderr.write('Writing relationships to database...')
-        idx = 1
+        stats.startPhase('edgeWrite')
+        if self.useTransactions:
+            self._writeEdgesInTransactions()
+            self._endPhase('edgeWrite')
+            return
+        idx = self.nodeFarm.getJournal('edges') + 1
         while True:
-            subset = self.nodeFarm.getEdgeBatch(idx, batchSize)
+            subset = self.nodeFarm.getEdgeBatch(idx, sizer.size, withNodeRefs=True)
             batchLen = len(subset)
             if batchLen == 0:
                 break
             edgeRefs = []
+            nodes = {}
             for edge in subset:
 #                print edge['relationship'] ###
 #                if edge['properties']:
 #                    print '   ' + repr(edge['properties'])
-                ref1 = self.nodeRefs[edge['startNodeHash']]
+                for nodeRef in (edge['startNodeRef'], edge['endNodeRef']):
+                    if nodeRef not in nodes:
+                        nodes[nodeRef] = self.graph_db.node(nodeRef)
+                ref1 = nodes[edge['startNodeRef']]
 #                print '  getting endNode' ###
-                ref2 = self.nodeRefs[edge['endNodeHash']]
+                ref2 = nodes[edge['endNodeRef']]
                 edgeRef = [ref1, edge['relationship'], ref2]
                 if edge['properties']:
                     edgeRef.append(edge['properties'])
                 edgeRefs.append(tuple(edgeRef))
-            _serverCall(self.graph_db.create, *edgeRefs)
+                stats._count(stats.relationshipCounts, edge['relationship'])
+            self._createInBatches(edgeRefs, sizer)
             # self._extractState['relationCnt'] += batchLen
-            idx += batchSize
+            idx += batchLen
+            self.nodeFarm.setJournal('edges', idx - 1)
             if verbose:
                 self._progressReport(idx, 0, self.maxEdges, 25, 100)
-        if verbose:
-            self._timeUpdate()
+        self._endPhase('edgeWrite')
+    
+    def _cypherSession(self):
+        # A Cypher session wants the root of the server, not the REST API location.
+        parts = urlparse.urlsplit(self.uri)
+        return py2neo.cypher.Session('%s://%s' % (parts.scheme, parts.netloc))
+    
+    def _writeNodesInTransactions(self):
+        '''
+        Writes the nodes with one UNWIND statement per node type in each batch.
+        The statements return the position of each node in its batch along with 
+        its new ID, so the IDs can be saved in the same order as with :meth:`_writeNodesToDatabase`.
+        '''
+        stats = self.importStats
+        verbose = self._extractState['verbose']
+        session = self._cypherSession()
+        tx = session.create_transaction()
+        uncommitted = 0
+        idx = self.nodeFarm.getJournal('nodes') + 1
+        while True:
+            subset = self.nodeFarm.getNodeBatch(idx, self.transactionBatchSize)
+            if not subset:
+                break
+            groups = {}
+            for i, row in enumerate(subset):
+                vertex = row['vertex']
+                groups.setdefault(vertex['type'], []).append({'i': i, 'props': vertex})
+                stats._count(stats.nodeCounts, vertex['type'])
+            for nodeType, rows in groups.iteritems():
+                tx.append(_UNWIND_NODES % _cypherName(nodeType), {'rows': rows})
+            nodeIds = [None] * len(subset)
+            for result in self._sendOnce(tx.execute):
+                for record in result:
+                    nodeIds[record[0]] = record[1]
+            self.nodeFarm.setNodeRefs([(subset[i]['hash'], nodeIds[i]) for i in range(len(subset))])
+            uncommitted += len(subset)
+            idx += len(subset)
+            if uncommitted >= self.commitSize:
+                self._sendOnce(tx.commit)
+                self.nodeFarm.setJournal('nodes', idx - 1)
+                tx = session.create_transaction()
+                uncommitted = 0
+            if verbose:
+                self._progressReport(idx, 0, self.maxNodes, 5, 25)
+        self._sendOnce(tx.commit)
+        self.nodeFarm.setJournal('nodes', idx - 1)
+    
+    def _writeEdgesInTransactions(self):
+        stats = self.importStats
+        verbose = self._extractState['verbose']
+        session = self._cypherSession()
+        tx = session.create_transaction()
+        uncommitted = 0
+        idx = self.nodeFarm.getJournal('edges') + 1
+        while True:
+            subset = self.nodeFarm.getEdgeBatch(idx, self.transactionBatchSize, withNodeRefs=True)
+            if not subset:
+                break
+            groups = {}
+            for edge in subset:
+                relation = edge['relationship']
+                groups.setdefault(relation, []).append({ 'start': edge['startNodeRef'],
+                                                         'end': edge['endNodeRef'],
+                                                         'props': edge['properties'] or {} })
+                stats._count(stats.relationshipCounts, relation)
+            for relation, rows in groups.iteritems():
+                tx.append(_UNWIND_RELATIONSHIPS % _cypherName(relation), {'rows': rows})
+            self._sendOnce(tx.execute)
+            uncommitted += len(subset)
+            idx += len(subset)
+            if uncommitted >= self.commitSize:
+                self._sendOnce(tx.commit)
+                self.nodeFarm.setJournal('edges', idx - 1)
+                tx = session.create_transaction()
+                uncommitted = 0
+            if verbose:
+                self._progressReport(idx, 0, self.maxEdges, 25, 100)
+        self._sendOnce(tx.commit)
+        self.nodeFarm.setJournal('edges', idx - 1)
 
 #-------------------------------------------------------------------------------
+def _matchTemplate(relation):
+    if isinstance(relation, Relationship):
+        return relation._template()
+    return str(relation)
+
+def _matchKey(relation):
+    if isinstance(relation, Relationship):
+        return relation._templateKey()
+    return str(relation)
+
+# Query templates by the structure of the query (see Query._compile).
+_queryTemplates = {}
+_QUERY_TEMPLATE_LIMIT = 1000
+
 class Query(object):
     '''This object provides an interface for building and executing queries of the
     database. The first argument to the object must be an existing
@@ -1287,13 +3647,19 @@ class Query(object):
     'results': 'Blah',
     'metadata': 'Blah',
     'pattern': 'Blah',
-    'nodes': 'Blah'
+    'nodes': 'Blah',
+    'optimize': 'If `True` (the default), the query may start from a node or relationship other than the one given to :meth:`setStartNode` or :meth:`setStartRelationship`, if the statistics of the database suggest it will be faster. The results are the same.',
+    'expansionCost': 'How many times more it costs to expand an entity into the rest of the pattern than to read it from the index, when :attr:`optimize` chooses where to start (default=10).'
     }
+    optimize = True
+    expansionCost = 10
     
     def __init__(self, db):
         self.db = db
         self._constructCallbacks = {}
         self.start = self.pattern = None
+        self.startEntity = None
+        self.startId = None
         self.startNodes = []
         self.match = []
         self.optionalMatch = []
@@ -1333,6 +3699,20 @@ class Query(object):
         Metadata1
         
         Calling this method again will add another start node to the query.
+        With `noIndex` set to `True`, the node is matched by its type instead of
+        being read from the index.
+
+        >>> q = Query(db)
+        >>> score = q.setStartNode(nodeType='Score')
+        >>> meta = q.setStartNode(nodeType='Metadata', noIndex=True)
+        >>> len(q.results().fetch_all())
+        1
+        
+        Paged results (see :meth:`results`) have the same columns, plus the cursor:
+        
+        >>> paged = q.results(limit=10, after=-1).fetch_all()
+        >>> len(paged), len(paged[0]) == len(q.results().fetch_all()[0]) + 1
+        (1, True)
         '''
         self.pattern = None
         if node == None:
@@ -1340,6 +3720,7 @@ class Query(object):
         if overWrite:
             del self.startNodes[:]
         if node.id:
+            self.startEntity = None
             self.startNodes.append(node)
         elif noIndex:
             self.match = ['(%s)' % node.name]
@@ -1347,11 +3728,12 @@ class Query(object):
             self.addComparisonFilter(node.type, '=', nodeType)
         else:
             self.start = 'start %s=node:node_auto_index("type:%s")\n' % (node.name, node.nodeType)
+            self.startEntity = node
         #self.order = 'order by ID(%s)\n' % node.name
         self.startId = 'ID(%s)' % node.name 
         return node
 
-    def results(self, limit=None, pattern=None, omitStart=False):
+    def results(self, limit=None, pattern=None, omitStart=False, after=None, cache=True):
         '''
         Executes a query of the database using the current state of the Query object.
         Returns a tuple containing first the results, then the query metadata. 
@@ -1376,15 +3758,52 @@ class Query(object):
         Score1
         >>> print q.results()
         ([[Node('http://localhost:7474/db/data/node/...')]], [u'Score1'])
+        
+        Without a `limit`, no more than 100 results are returned. To page through 
+        a longer list of results, give an `after` cursor: the results are then 
+        ordered by the ID of the start node or relationship, and only those after 
+        the cursor are returned. Use -1 for the first page. A page holds all the 
+        results of no more than `limit` start nodes or relationships, so it can have 
+        more than `limit` rows, and a page with results from fewer than `limit` of them 
+        is the last one. Each row has the ID of its start node or relationship as an 
+        extra last column, and the `cursor` attribute of the returned
+        :class:`Results` object holds the cursor for the next page once
+        the page has been read. Since the query restarts from the cursor, later pages 
+        don't require the earlier ones to be read again.
+        
+        >>> r = q.results(limit=1, after=-1)
+        >>> page = r.fetch_all()
+        >>> r.cursor == page[-1][-1]
+        True
+        >>> q.results(limit=1, after=r.cursor).fetch_all()
+        []
+        
+        The notes of a measure are never split between pages:
+        
+        >>> q = Query(db)
+        >>> m = q.setStartNode(nodeType='Measure')
+        >>> inMeasure = q.addRelationship(relationType='NoteInMeasure', end=m)
+        >>> r = q.results(limit=1, after=-1)
+        >>> page = r.fetch_all()
+        >>> len(page) > 1 and len(set(row[-1] for row in page)) == 1
+        True
+        >>> rest = q.results(limit=10000, after=r.cursor).fetch_all()
+        >>> len(page) + len(rest) == len(q.results(limit=10000).fetch_all())
+        True
+        
+        Results are cached by the Database until the database changes 
+        (see :meth:`Database.cacheStats`), unless `cache` is `False`. 
+        A cached result is returned at once, without a query to the server.
         '''
         # import py2neo.cypher as cypher
-
-        if not pattern:
-            pattern = self._assemblePattern(limit=limit, omitStart=omitStart)
-        #params = { 'minRow': minRow, 'maxResults': limit }
-        r = Results(pattern)
-        r.start()
-        return r
+        
+        if pattern:
+            params = None
+            if after is not None:
+                params = { 'after': after, 'limit': limit or 100 }
+        else:
+            pattern, params = self._compile(limit, after)
+        return self.db._results(pattern, params, after, cache)
         #results, columns = _cypherQuery(self.db.graph_db, pattern, params)
         # _fix535(results, metadata) # Remove when issue 535 is fixed (introduced around Neo4j 1.8.1)
         #return results, columns
@@ -1445,6 +3864,7 @@ class Query(object):
             self.addRelationship(relation)
         self.start = ('start %s=relationship:relationship_auto_index("type:%s")\n' 
                       % (relation.name, relation.relationType))
+        self.startEntity = relation
         #self.order = 'order by ID(%s)\n' % relation.name
         self.startId = 'ID(%s)' % relation.name 
         return relation
@@ -1553,7 +3973,7 @@ class Query(object):
         >>> q.addCypherFilter('abs(%s.midi- %s.midi) %% 12 = 7' % (nSWN.start.name, nSWN.end.name))
         >>> results, meta = q.results(limit=100)
         >>> print len(results)
-        70
+        63
         
         But we can create this filter more directly using the `simpleHarmonicInterval` property
         of `NoteSimultaneousWithNote` relationships:
@@ -1814,13 +4234,158 @@ class Query(object):
             for cName, ref in classes:
                 self.m21_classes[mName][cName] = ref
 
-    def _assemblePattern(self, limit=None, distinct=False, omitStart=False):
-        if self.pattern:
-            return self.pattern
+    def _compile(self, limit=None, after=None):
+        '''Returns the Cypher text of the query as a template, and a dict of the parameters
+        to run it with. Values that change between otherwise identical queries (the IDs of start
+        nodes, the values compared by filters, relationship properties, and the limit) are 
+        parameters, so the server can reuse its plan for the template. Templates are 
+        cached by the structure of the query, so a query of the same shape isn't assembled twice.
+        If `after` is given, the template is paged (see :meth:`results`).
+        '''
+        paged = after is not None
+        anchor = self._chooseAnchor()
+        key = self._templateKey(paged, anchor)
+        try:
+            pattern = _queryTemplates[key]
+        except KeyError:
+            pattern = self._assemblePattern(paged, anchor)
+            if len(_queryTemplates) >= _QUERY_TEMPLATE_LIMIT:
+                _queryTemplates.clear()
+            _queryTemplates[key] = pattern
+        if not paged:
+            self.pattern = pattern
+        params = { 'limit': limit or 100 }
+        if paged:
+            params['after'] = after
+        for i, node in enumerate(self.startNodes):
+            params['start%d' % i] = node.id
+        for i, filt in enumerate(self.where):
+            if isinstance(filt, Filter):
+                filt._addParameters('filter%d' % i, params)
+        for relation in self.match + self.optionalMatch:
+            if isinstance(relation, Relationship):
+                relation._addParameters(params)
+        return pattern, params
+
+    def _templateKey(self, paged, anchor=None):
+        start = self.start
+        if self.startNodes:
+            start = tuple([n.name for n in self.startNodes])
+        elif anchor is not self.startEntity:
+            start = (start, anchor.name)
+        relations = tuple([_matchKey(r) for r in self.match])
+        optionalRelations = tuple([_matchKey(r) for r in self.optionalMatch])
+        filters = []
+        for filt in self.where:
+            if isinstance(filt, Filter):
+                filt = filt._templateKey()
+            filters.append(filt)
+        returns = tuple([str(x) for x in self.returns])
+        return (start, self.startId, relations, optionalRelations, tuple(filters), returns, paged)
+
+    def _chooseAnchor(self):
+        '''Returns the node or relationship the query should start from. This is the 
+        start entity unless :attr:`optimize` is set and the statistics of the database
+        show that another typed node or relationship in the pattern is cheaper to start from.
+        
+        Only entities whose type is already enforced by the query are considered, 
+        so the results are the same: relationships with a type, and nodes at the end of 
+        a typed relationship that only ever connects to nodes of their type. The cost of 
+        an anchor is the number of entities of its type (which are all read from the index),
+        plus the number expected to pass the filters on it, which are expanded into the rest 
+        of the pattern, weighted by :attr:`expansionCost`. The statistics come from the catalog kept by :meth:`Database.addScore`;
+        without one, the query starts from the start entity.
+        '''
+        start = self.startEntity
+        if not self.optimize or start is None or self.startNodes or not self.match:
+            return start
+        catalog = self.db._queryCatalog()
+        if catalog is None:
+            return start
+        relations = self.match
+        if not all(isinstance(r, Relationship) for r in relations):
+            return start
+        typed = [r for r in relations if r.relationType != '*' and not r.maxDistance]
+        if not typed or not self._isConnected(start):
+            return start
+        candidates = [start] + [r for r in typed if r is not start]
+        ends = [(r, node, end) for r in typed for node, end in ((r.start, 'start'), (r.end, 'end'))
+                if node.nodeType != '*' and node is not start]
+        if ends:
+            endTypes = {}
+            for triple in catalog.relationshipTypes():
+                endTypes.setdefault((triple['type'], 'start'), set()).add(triple['start'])
+                endTypes.setdefault((triple['type'], 'end'), set()).add(triple['end'])
+            for r, node, end in ends:
+                if node not in candidates and endTypes.get((r.relationType, end)) == set([node.nodeType]):
+                    candidates.append(node)
+        if len(candidates) < 2:
+            return start
+        best = start
+        bestCost = self._anchorCost(start, catalog)
+        for entity in candidates[1:]:
+            cost = self._anchorCost(entity, catalog)
+            if cost < bestCost:
+                best, bestCost = entity, cost
+        return best
+
+    def _isConnected(self, start):
+        '''Whether all the required relationships of the query form one pattern
+        that includes the start entity.
+        '''
+        neighbours = {}
+        for r in self.match:
+            neighbours.setdefault(r.start.name, set()).add(r.end.name)
+            neighbours.setdefault(r.end.name, set()).add(r.start.name)
+        if isinstance(start, Relationship):
+            if start not in self.match:
+                return False
+            first = start.start.name
+        else:
+            first = start.name
+        if first not in neighbours:
+            return False
+        seen = set([first])
+        pending = [first]
+        while pending:
+            for name in neighbours[pending.pop()]:
+                if name not in seen:
+                    seen.add(name)
+                    pending.append(name)
+        return len(seen) == len(neighbours)
+
+    def _anchorCost(self, entity, catalog):
+        if isinstance(entity, Relationship):
+            kind, entityType = 'relationships', entity.relationType
+        else:
+            kind, entityType = 'nodes', entity.nodeType
+        count = catalog.counts(kind).get(entityType, 0)
+        values = catalog.valueCounts(kind, entityType)
+        selectivity = 1.0
+        for filt in self.where:
+            if isinstance(filt, Filter):
+                selectivity *= filt._selectivity(entity, values, count)
+        return count * (1 + self.expansionCost * selectivity)
+
+    def _assemblePattern(self, paged=False, anchor=None):
+        '''Assembles the template returned by :meth:`_compile`, starting from the
+        `anchor` entity if it isn't the start entity of the query.
+        '''
         startStr = ''
+        where = []
         #if not omitStart:
         if self.startNodes:
-            startStr = 'start ' + ', '.join(['%s=node(%d)' % (n.name, n.id) for n in self.startNodes]) + '\n'
+            startStr = 'start ' + ', '.join(['%s=node({start%d})' % (n.name, i) 
+                                             for i, n in enumerate(self.startNodes)]) + '\n'
+        elif anchor is not self.startEntity:
+            if isinstance(anchor, Relationship):
+                startStr = ('start %s=relationship:relationship_auto_index("type:%s")\n' 
+                            % (anchor.name, anchor.relationType))
+            else:
+                startStr = 'start %s=node:node_auto_index("type:%s")\n' % (anchor.name, anchor.nodeType)
+            if isinstance(self.startEntity, Node):
+                # The type of the start node was enforced by the index.
+                where.append('%s.type = "%s"' % (self.startEntity.name, self.startEntity.nodeType))
         else:
             startStr = self.start
         if startStr == None:
@@ -1828,26 +4393,61 @@ class Query(object):
             sys.exit(1)
         matchStr = optMatchStr = whereStr = ''
         if self.match:
-            matchStr = 'match\n' + ',\n'.join([str(x) for x in self.match]) + '\n'
-        if self.where:
-            whereStr = 'where\n' + '\nand '.join([str(x) for x in self.where]) + '\n'
+            matchStr = 'match\n' + ',\n'.join([_matchTemplate(x) for x in self.match]) + '\n'
+        for i, filt in enumerate(self.where):
+            if isinstance(filt, Filter):
+                filt = filt._template('filter%d' % i)
+            where.append(filt)
+        if where:
+            whereStr = 'where\n' + '\nand '.join(where) + '\n'
+        if paged:
+            # Page over distinct start entities, so the rows of one are never split between pages.
+            pageName = self.startId[len('ID('):-1]
+            if self.startEntity is not None:
+                # A node added with noIndex is matched again for each start entity.
+                pageName = self.startEntity.name
+            pageId = 'ID(%s)' % pageName
+            carried = [pageName] + [n.name for n in self.startNodes if n.name != pageName]
+            pageWhere = where + ['%s > {after}' % pageId]
+            startStr += (matchStr + 'where\n' + '\nand '.join(pageWhere) + '\n' +
+                         'with distinct %s, %s AS musicNetCursor\n' % (', '.join(carried), pageId) +
+                         'order by musicNetCursor\nlimit {limit}\n')
+            if not self.match:
+                whereStr = ''
         if self.optionalMatch:
-            optMatchStr = '\n'.join(['optional match\n' + str(x) for x in self.optionalMatch]) + '\n'            
+            optMatchStr = '\n'.join(['optional match\n' + _matchTemplate(x) for x in self.optionalMatch]) + '\n'            
         props = []
         if self.returns:
-            props = self.returns[:]
+            for prop in self.returns:
+                prop = str(prop)
+                if prop not in props:
+                    props.append(prop)
+        elif paged:
+            # RETURN * would include the cursor, but not as the last column.
+            props.extend(self._identifiers())
         else:
             props.append('*')
-        props = [str(x) for x in set(props)]
         distinctStr = ''
-        limitStr = ''
-        if limit:
-            limitStr = 'LIMIT %d\n' % limit
-        else:
-            limitStr = 'LIMIT 100'
+        limitStr = 'LIMIT {limit}\n'
+        if paged:
+            props.append('musicNetCursor')
+            limitStr = 'ORDER BY musicNetCursor\n'
         returnStr = 'return ' + distinctStr + ', '.join(props) + '\n'
-        self.pattern = startStr + matchStr + whereStr + optMatchStr + returnStr + limitStr + ';'
-        return self.pattern
+        return startStr + matchStr + whereStr + optMatchStr + returnStr + limitStr + ';'
+
+    def _identifiers(self):
+        # The names bound by the query, in the order they appear in it.
+        names = [n.name for n in self.startNodes]
+        if self.startEntity is not None:
+            names.append(self.startEntity.name)
+        if self.startId:
+            names.append(self.startId[len('ID('):-1])
+        for relation in self.match + self.optionalMatch:
+            if isinstance(relation, Relationship):
+                names.extend([relation.start.name, relation.name, relation.end.name])
+            else:
+                names.append(str(relation).strip('()'))
+        return [x for i, x in enumerate(names) if x not in names[:i]]
 
     def _addHierarchicalNodes(self, results, metadata, buildFullScore):
         ''' Fill in a minimal score hierarchy sufficient to contain the notes in the result.
@@ -1913,9 +4513,10 @@ class Query(object):
         ''' Add all the children of this node that are connected by the specified Relationship type.
         '''
         q = Query(self.db)
-        n = Node(q, nodeId=_id(node))
+        # Fixed names give every call the same query template.
+        n = Node(q, nodeId=_id(node), name='parent')
         q.setStartNode(n)
-        r = Relationship(q, relationType=rType, end=n)
+        r = Relationship(q, relationType=rType, start=Node(q, name='child'), end=n, name='childRelation')
         if structural:
             r.properties = {'structural': True}
         q.addRelationship(r)
@@ -2099,6 +4700,23 @@ class Relationship(Entity):
         self._addName(name)
 
     def __repr__(self):
+        return self._pattern(False)
+    
+    def _template(self):
+        return self._pattern(True)
+
+    def _templateKey(self):
+        props = None
+        if self.properties:
+            props = tuple(sorted(self.properties))
+        return (self.start.name, self.name, self.relationType, self.maxDistance, props, self.end.name)
+
+    def _addParameters(self, params):
+        if self.properties:
+            for k, v in self.properties.items():
+                params['%s_%s' % (self.name, k)] = v
+
+    def _pattern(self, template):
         distance = props = ''
         delimiter = ':'
         rType = self.relationType
@@ -2110,7 +4728,9 @@ class Relationship(Entity):
         elif rType == '*':
             rType = ''
             delimiter = ''
-        if (self.properties):
+        if template and self.properties:
+            props = ' {' + ','.join(['%s:{%s_%s}' % (k, self.name, k) for k in self.properties]) + '}'
+        elif self.properties:
             props = ' {' + ','.join(['%s:%s' % (k, repr(v)) for k, v in self.properties.items()]) + '}'
         return '(%s)-[%s%s%s%s%s]->(%s)' % (self.start, self.name, delimiter, rType, distance, props, self.end)
 
@@ -2172,6 +4792,79 @@ class Filter(Entity):
                 operands.append(str(operand))
         return '%s %s %s' % (operands[0], self.operator, operands[1])
     
+    def _template(self, paramName):
+        operands = []
+        for side, operand in (('pre', self.pre), ('post', self.post)):
+            if isinstance(operand, Entity):
+                operands.append(str(operand))
+            else:
+                operands.append('{%s_%s}' % (paramName, side))
+        return '%s %s %s' % (operands[0], self.operator, operands[1])
+
+    def _templateKey(self):
+        operands = []
+        for operand in (self.pre, self.post):
+            if isinstance(operand, Entity):
+                operand = str(operand)
+            else:
+                operand = None
+            operands.append(operand)
+        return (operands[0], self.operator, operands[1])
+
+    _comparisons = { '=': operator.eq, '<>': operator.ne, '<': operator.lt, 
+                     '>': operator.gt, '<=': operator.le, '>=': operator.ge }
+    _mirrored = { '<': '>', '>': '<', '<=': '>=', '>=': '<=' }
+    
+    def _selectivity(self, entity, values, total):
+        '''Estimates the fraction of the `total` entities for which this filter is true, 
+        if it compares a property of `entity` with a value, from the `values` of that property 
+        in the database (a dict of property names, each with a dict of the number of 
+        entities with each value). The value is compared as it is sent to the database, 
+        so `True` matches the text 'True' and text never matches a number.
+        
+        >>> q = Query(Database())
+        >>> r = q.setStartRelationship(relationType='NoteSimultaneousWithNote')
+        >>> f = Filter(q, r.sameOffset, '=', True)
+        >>> f._selectivity(r, {'sameOffset': {u'True': 3, u'False': 1}}, 4)
+        0.75
+        '''
+        if isinstance(self.pre, Property) and not isinstance(self.post, Entity):
+            prop, op, value = self.pre, self.operator, self.post
+        elif isinstance(self.post, Property) and not isinstance(self.pre, Entity):
+            prop, op, value = self.post, self._mirrored.get(self.operator, self.operator), self.pre
+        else:
+            return 1.0
+        known = values.get(prop.name)
+        if prop.parent is not entity or not known or op not in self._comparisons:
+            return 1.0
+        compare = self._comparisons[op]
+        value = self._parameterValue(value)
+        isText = isinstance(value, basestring)
+        matched = 0
+        for v, count in known.iteritems():
+            if isinstance(v, basestring) != isText:
+                # Python 2 orders text and numbers, but the database doesn't match them.
+                continue
+            try:
+                if compare(v, value):
+                    matched += count
+            except TypeError:
+                matched += count
+        return max(matched, 1) / float(max(total, sum(known.itervalues()), 1))
+
+    @staticmethod
+    def _parameterValue(operand):
+        if isinstance(operand, bool):
+            # Compared as text, as in the quoted form of __repr__
+            return unicode(operand)
+        return operand
+    
+    def _addParameters(self, paramName, params):
+        for side, operand in (('pre', self.pre), ('post', self.post)):
+            if isinstance(operand, Entity):
+                continue
+            params['%s_%s' % (paramName, side)] = self._parameterValue(operand)
+    
     def __getattr__(self):
         raise AttributeError
 
@@ -2245,11 +4938,68 @@ class Test(unittest.TestCase):
     def runTest(self):
         pass
     
+    def testExportImportFiles(self):
+        # The files are written from a small score built in memory, without a database server.
+        import csv
+        import shutil
+        score = music21.stream.Score()
+        for pitches in (['C4', 'E4'], ['G3']):
+            part = music21.stream.Part()
+            measure = music21.stream.Measure()
+            measure.append(music21.meter.TimeSignature('4/4'))
+            for pitch in pitches:
+                measure.append(music21.note.Note(pitch, quarterLength=4.0 / len(pitches)))
+            part.append(measure)
+            score.insert(0, part)
+        addMomentsToScore(score)
+        directory = tempfile.mkdtemp()
+        try:
+            files = Database().exportImportFiles([score], directory)
+            def read(path):
+                with open(path, 'rb') as fh:
+                    return list(csv.reader(fh))
+            headers = {}
+            nodeIds = set()
+            for headerPath, dataPath in files['nodes']:
+                header = read(headerPath)[0]
+                self.assertEqual(header[:2], [':ID', ':LABEL'])
+                for column in header[2:]:
+                    self.assertIn(column.rsplit(':', 1)[1], ('boolean', 'long', 'double', 'string'))
+                label = os.path.basename(dataPath)[len('nodes_'):-len('.csv')]
+                headers[label] = header
+                for row in read(dataPath):
+                    self.assertEqual(len(row), len(header))
+                    self.assertEqual(row[1], label)
+                    self.assertNotIn(int(row[0]), nodeIds)
+                    nodeIds.add(int(row[0]))
+            self.assertEqual(len(nodeIds), files['nodeCount'])
+            self.assertEqual(nodeIds, set(range(files['nodeCount'])))
+            self.assertTrue(set(['midi:long', 'offset:double', 'pitch:string']) <= set(headers['Note']))
+            self.assertIn('contentHash:string', headers['Score'])
+            relationshipCount = 0
+            for headerPath, dataPath in files['relationships']:
+                header = read(headerPath)[0]
+                self.assertEqual(header[:3], [':START_ID', ':END_ID', ':TYPE'])
+                for column in header[3:]:
+                    self.assertIn(column.rsplit(':', 1)[1], ('boolean', 'long', 'double', 'string'))
+                label = os.path.basename(dataPath)[len('relationships_'):-len('.csv')]
+                for row in read(dataPath):
+                    self.assertEqual(len(row), len(header))
+                    self.assertEqual(row[2], label)
+                    self.assertIn(int(row[0]), nodeIds)
+                    self.assertIn(int(row[1]), nodeIds)
+                    relationshipCount += 1
+            self.assertEqual(relationshipCount, files['relationshipCount'])
+            self.assertIn(os.path.join(directory, 'relationships_NoteInMeasure.csv'), 
+                          [x[1] for x in files['relationships']])
+        finally:
+            shutil.rmtree(directory)
+    
 class TestExternal(unittest.TestCase):
     def runTest(self):
         pass
 
-_DOC_ORDER = [Query, Database, Entity, Node, Relationship, Property, Filter, Moment]
+_DOC_ORDER = [Query, Database, ImportStats, Entity, Node, Relationship, Property, Filter, Moment]
 
 # This Source Code Form is subject to the terms of the Mozilla Public License, v. 2.0. 
 # If a copy of the MPL was not distributed with this file, You can obtain one at 
@@ -75,19 +75,24 @@ def listScores():
     '''
     Server address::
  
-        /listscores?start=0&limit=100
+        /listscores?start=0&limit=100&composer=bach&sort=movementName
     
     Request parameters::
     
         start - The first row of scores to return (default=0).
         limit - The number of scores to return (default=100).
+        composer - Only list scores with a contributor name containing this text (optional).
+        title - Only list scores with a movement name containing this text (optional).
+        path - Only list scores with a corpus file path containing this text (optional).
+        sort - corpusFilepath, movementName or composer (default=corpusFilepath).
+        reverse - 1 to list the scores in reverse order (default=0).
     
     Response: a JSONItem dictionary for each score in the database.
     
     Data structure::
 
-        { movementName: name_of_score_file, _names: [ contributor, ... ], index: original_path_of_score_file }
-        { movementName: name_of_score_file, _names: [ contributor, ... ], index: original_path_of_score_file }
+        { movementName: name_of_score_file, _names: [ contributor, ... ], corpusFilepath: original_path_of_score_file }
+        { movementName: name_of_score_file, _names: [ contributor, ... ], corpusFilepath: original_path_of_score_file }
         ...
     
     We can test the functionality of the app without actually starting it by using the :class:`webtest`
@@ -104,7 +109,9 @@ def listScores():
     query = flask.request.args
     start = int(query.get('start', '0'))
     limit = int(query.get('limit', '100'))
-    rows = app.db.listScores(start, limit)
+    rows = app.db.listScores(start, limit, composer=query.get('composer'), title=query.get('title'), 
+                             path=query.get('path'), sortBy=query.get('sort', 'corpusFilepath'), 
+                             reverse=query.get('reverse', '0') == '1')
     for row in rows:
         yield json.dumps(row) + '\n'
 
@@ -224,12 +231,13 @@ def listRelationshipTypes():
     Response: 
     
         A JSONItem dictionary for each kind of relationship in the database, including
-        the type of node at the start and end of the relationship.
+        the type of node at the start and end of the relationship, and the number 
+        of relationships of that kind.
     
     Data structure::
     
-        {'start': u'Note', 'end': u'Measure', 'type': u'NoteInMeasure'}
-        {'start': u'Part', 'end': u'Score', 'type': u'PartInScore'}
+        {'start': u'Note', 'end': u'Measure', 'type': u'NoteInMeasure', 'count': 218}
+        {'start': u'Part', 'end': u'Score', 'type': u'PartInScore', 'count': 4}
         ...
     
     Example:
@@ -239,8 +247,11 @@ def listRelationshipTypes():
     >>> webapp = TestApp(mns.app)
     >>> r = webapp.get('/listrelationshiptypes')
     >>> import json
-    >>> json.loads(r.body.splitlines()[0])
-    {u'start': u'Note', u'end': u'Measure', u'type': u'NoteInMeasure'}
+    >>> rows = [json.loads(x) for x in r.body.splitlines()]
+    >>> sorted(rows[0])
+    [u'count', u'end', u'start', u'type']
+    >>> print [(x['start'], x['end'], x['count']) for x in rows if x['type'] == 'NoteInMeasure']
+    [(u'Note', u'Measure', 218)]
     '''
     rows = app.db.listRelationshipTypes()
     def generate():
@@ -492,17 +503,17 @@ def prepareQuery():
         p = partsForMeasures.itervalues().next()
         r = q.addRelationship(relationType='PartInScore', start=p, end=scoreNode, name=p.name+'In'+scoreNode.name)
     previews = req.get('makePreviews', False)
-    pattern = q._assemblePattern(distinct=True)
+    pattern, params = q._compile()
+    pagedPattern, pagedParams = q._compile(after=-1)
     if not pattern:
         result = {'error': 'Unable to assemble valid query.'}
     else:
         print pattern ###
         ipAddr = flask.request.remote_addr or "None"
-        token = hash(ipAddr + pattern)
-        rGen = music21.musicNet.Results(pattern)
-        rGen.start()
+        token = hash(ipAddr + pattern + repr(sorted(params.items())))
+        rGen = app.db._results(pattern, params)
         app.rGens[token] = rGen
-        app.tokens[token] = [pattern, columns, previews, time.time()]
+        app.tokens[token] = [pattern, columns, previews, time.time(), pagedPattern, pagedParams]
         result = { 'token': token }
     expireTokens()
     print 'result: ' + str(result) ###
@@ -552,12 +563,14 @@ def results():
     Server address::
      
         /getresults?token=nnn&row=0&limit=10
+        /getresults?token=nnn&after=-1&limit=10
     
     Request parameters::
 
         token - The number returned by the submitquery service
         row   - The first row of the query to return (default=0)
         limit - The number of query results to return (default=10)
+        after - A cursor from a previous response, or -1 for the first page (optional)
     
     Response: 
     
@@ -569,7 +582,15 @@ def results():
         
         A typical strategy is to send requests to this service,
         incrementing the row by the limit each time, until it
-        returns an empty response.
+        returns an empty response. Without the `after` parameter
+        no more than the first 100 results are available.
+        
+        With the `after` parameter, the query is run again for each page,
+        starting after the cursor, so any number of results can be read
+        without reading the earlier pages again. A page holds all the results 
+        of up to `limit` start nodes (or relationships), so it can have more than
+        `limit` data rows. The last item of the response has the cursor to use 
+        for the next page, with a 'type' of 'cursor'; its data is null on the last page.
     
     Data structure::
     
@@ -595,23 +616,40 @@ def results():
     token = int(args.get('token', ''))
     minRow = int(args.get('row', '0'))
     limit = int(args.get('limit', '10'))
-    return flask.Response(generate_results(token, minRow, limit), mimetype='application/json')
+    after = args.get('after', None)
+    if after is not None:
+        after = int(after)
+    return flask.Response(generate_results(token, minRow, limit, after), mimetype='application/json')
 
-def generate_results(token, minRow, limit):
+def generate_results(token, minRow, limit, after=None):
     try:
         rGen = app.rGens[token]
-        pattern, columns, previews, timestamp = app.tokens[token]
+        pattern, columns, previews, timestamp, pagedPattern, pagedParams = app.tokens[token]
     except KeyError:
         item = { 'error': 'That token is invalid or has expired.' }
         yield json.dumps(item) + '\n'
         raise StopIteration
-    data = rGen.next(limit)
+    if after is not None:
+        params = dict(pagedParams, after=after, limit=limit)
+        rGen = app.db._results(pagedPattern, params, after)
+        data = rGen.fetch_all()
+    else:
+        data = rGen.next(limit)
     if not data:
+        if after is not None:
+            # An empty page still ends with the cursor, which marks the end of the results.
+            item = { 'type': 'cursor', 'data': None }
+            yield json.dumps(item) + '\n'
         raise StopIteration
     metadata = _getPy2neoMetadata(data[0])
     #data[0]._fields
     print metadata
     data = [tuple(x) for x in data]
+    if after is not None:
+        # The last column is the cursor, which is sent once at the end.
+        starts = len(set(x[-1] for x in data))
+        metadata = list(metadata)[:-1]
+        data = [x[:-1] for x in data]
     rLookup = {}
     for i in range(len(metadata)):
         rLookup[metadata[i]] = i
@@ -632,6 +670,9 @@ def generate_results(token, minRow, limit):
         item = { 'type': 'data', 'index': queryIdx, 'data': output }
         print item
         yield json.dumps(item) + '\n'
+    if after is not None:
+        item = { 'type': 'cursor', 'data': rGen.cursor if starts >= limit else None }
+        yield json.dumps(item) + '\n'
     expireTokens()
         
 @app.route('/getimages')
@@ -688,7 +729,7 @@ def generate_images(token):
         item = { 'error': 'That token is invalid or has expired.' }
         yield json.dumps(item) + '\n'
         raise StopIteration
-    makePreviews = app.tokens[token][1]
+    makePreviews = app.tokens[token][2]
     if not makePreviews:
         item = { 'error': 'makePreviews was not set in the query submission.' }
         yield json.dumps(item) + '\n'
@@ -803,10 +844,14 @@ def objectValueMap(data):
         return '-'
 
 def expireTokens():
-    # Remove tokens that are older than 30 minutes.
-    for token in app.tokens:
-        if app.tokens[token][2] - time.time() > 1800:
+    # Remove tokens that are older than 30 minutes, and stop their queries.
+    now = time.time()
+    for token in app.tokens.keys():
+        if now - app.tokens[token][3] > 1800:
             del app.tokens[token]
+            rGen = app.rGens.pop(token, None)
+            if rGen is not None:
+                rGen.stop()
 
 
 if __name__ == "__main__":
@@ -817,12 +862,17 @@ if __name__ == "__main__":
     (options, args) = parser.parse_args()
     
     start = time.clock()
-    print "Loading relationship types..."
-    app.db.listRelationshipTypes()
-    print "Loading node property values..."
-    app.db.listNodePropertyValues()
-    print "Loading relationship property values..."
-    app.db.listRelationshipPropertyValues()
+    if app.db._loadCatalog() is None:
+        # Without a catalog the lists are found by scanning the database, which is 
+        # left to the first request that needs them.
+        print "The database has no catalog; run scripts/rebuild_catalog.py to build it."
+    else:
+        print "Loading relationship types..."
+        app.db.listRelationshipTypes()
+        print "Loading node property values..."
+        app.db.listNodePropertyValues()
+        print "Loading relationship property values..."
+        app.db.listRelationshipPropertyValues()
     
     print 'Running. (Startup in %d seconds)' % (time.clock() - start)
     app.run(host=options.address) #reloader=True
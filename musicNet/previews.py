@@ -39,11 +39,8 @@ class GeneratePreviews(multiprocessing.Process):
             pass
 
     def run(self, uri='http://localhost:7474/db/data/', **kwargs):
-        # hack to get py2neo to play nice with multiprocessing
-        py2neo.packages.httpstream.http.ConnectionPool._puddles = {}
-        #1.4: py2neo.rest._thread_local = threading.local()
-        #
-        db = music21.musicNet.Database()
+        # The Database shares this process's connection pool (see musicNet.getGraphDatabase).
+        db = music21.musicNet.Database(uri, **kwargs)
         while True:
             val = self.redis.lpop('inQueue')
             if val == None:
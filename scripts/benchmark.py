@@ -0,0 +1,207 @@
+#!/usr/bin/python
+
+import sys
+import time
+import heapq
+import weakref
+import optparse
+from music21.musicNet import *
+from music21 import *
+
+'''
+Benchmarks for the musicNet import pipeline. Each benchmark checks that the
+current code produces the same output as the implementation it replaced.
+
+    $ python benchmark.py moments -p bach/goldbergVariations_bwv988.mxl
+    $ python benchmark.py extract -p bach/goldbergVariations_bwv988.mxl
+
+The writes benchmark compares the ways of writing a score to a Neo4j server.
+It wipes the database, so use a local scratch server:
+
+    $ python benchmark.py writes -p bach/bwv84.5.mxl -u http://localhost:7474/db/data/
+'''
+
+def legacyMoments(score):
+    # The heap/WeakSet implementation formerly used by addMomentsToScore.
+    attackLookup = {}
+    addNotesFromStream(attackLookup, score, 0)
+    attackOffsets = attackLookup.keys()
+    attackOffsets.sort()
+    releaseOffsets = []
+    releaseLookup = {}
+    moments = []
+    for offset in attackOffsets:
+        moment = Moment()
+        while (releaseOffsets and releaseOffsets[0] <= offset):
+            del releaseLookup[releaseOffsets[0]]
+            heapq.heappop(releaseOffsets)
+        for r in releaseOffsets:
+            for n in releaseLookup[r]:
+                moment.addComponents(n, sameOffset=False)
+        notes = attackLookup[offset]
+        for note in notes:
+            moment.addComponents(note, sameOffset=True)
+            noteReleaseOffset = offset + note.quarterLength
+            if (noteReleaseOffset not in releaseOffsets):
+                heapq.heappush(releaseOffsets, noteReleaseOffset)
+                releaseLookup[noteReleaseOffset] = weakref.WeakSet()
+            releaseLookup[noteReleaseOffset].add(note)
+        moments.append((offset, moment))
+    return moments
+
+def momentContents(score):
+    moments = [x for x in score if isinstance(x, Moment)]
+    return [(m.offset, set(id(n) for n in m.getComponents())) for m in moments]
+
+def denseScore(parts=16, notes=400):
+    # Overlapping long notes in every part, to stress the number of sounding notes.
+    score = stream.Score()
+    for i in range(parts):
+        part = stream.Part()
+        for j in range(notes):
+            n = note.Note(40 + (i * 3 + j) % 40)
+            n.quarterLength = 1 + (i + j) % 7
+            part.insert(j * 0.5 + i * 0.25, n)
+            n.classes  # musicNet skips objects whose class list hasn't been cached yet
+        part.classes
+        score.insert(0, part)
+    score.classes
+    return score
+
+def benchmarkMoments(options):
+    path = options.path
+    if path:
+        score = corpus.parse(path)
+    else:
+        score = denseScore()
+    start = time.time()
+    legacy = legacyMoments(score)
+    legacyTime = time.time() - start
+    start = time.time()
+    getMomentArrays(score)
+    sweepTime = time.time() - start
+    start = time.time()
+    addMomentsToScore(score)
+    addTime = time.time() - start
+    expected = [(o, set(id(n) for n in m.getComponents())) for o, m in legacy]
+    identical = (expected == momentContents(score))
+    print 'Moments: %d (%s)' % (len(legacy), path or 'synthetic dense score')
+    print 'legacy Moments: %.3f s, sweep arrays: %.3f s, addMomentsToScore: %.3f s, identical: %s' % (
+        legacyTime, sweepTime, addTime, identical)
+    if not identical:
+        sys.exit(1)
+
+def legacyExtractObject(self, obj, objData=None, parentNode=None):
+    # The reflective implementation formerly used by Database._extractObject.
+    if isinstance(obj, Moment):
+        return
+    if not objData:
+        parentHash = None
+        if parentNode:
+            parentHash = parentNode['hash']
+        objData = self.nodeFarm.addNode(obj, parentHash)
+        self.maxNodes = self.maxNodes + 1
+    objectDict = obj.__dict__
+    vertex = objData['vertex']
+    for key, val in objectDict.iteritems():
+        if key in self._skipProperties:
+            continue
+        if val == None and key in ('_duration'):
+            continue
+        elif isinstance(val, list):
+            for item in val:
+                if hasattr(item, '__dict__'):
+                    self._extractNodes(item, objData)
+            continue
+        elif isinstance(val, dict):
+            for key, text in val.iteritems():
+                if key not in vertex:
+                    vertex[key] = str(text)
+            continue
+        elif isinstance(val, music21.musicxml.mxObjects.MusicXMLElement):
+            continue
+        elif hasattr(val, '__dict__'):
+            self._extractNodes(val, objData)
+            continue
+        if key == 'type':
+            key = 'm21_' + key
+        if key not in vertex:
+            vertex[key] = val
+    for key, val in vertex.items():
+        if not isinstance(val, (int, float, long)):
+            val = unicode(val)
+        if key not in vertex:
+            vertex[key] = val
+    self.nodeFarm.updateNode(objData, 'vertex', vertex)
+    return objData
+
+def extractScore(db, score):
+    db._prepareImport(False)
+    start = time.time()
+    db._extractNodes(score)
+    rows = db.nodeFarm.exportRows()
+    return time.time() - start, rows
+
+def benchmarkExtract(options):
+    path = options.path
+    score = corpus.parse(path or 'bach/goldbergVariations_bwv988.mxl')
+    addMomentsToScore(score)
+    db = Database()
+    compiled = Database._extractObject
+    Database._extractObject = legacyExtractObject
+    try:
+        legacyTime, legacyRows = extractScore(db, score)
+    finally:
+        Database._extractObject = compiled
+    compiledTime, compiledRows = extractScore(db, score)
+    identical = (legacyRows == compiledRows)
+    print 'Extracted %d nodes, %d relationships (%s)' % (len(compiledRows[0]), len(compiledRows[1]), 
+                                                         path or 'bach/goldbergVariations_bwv988.mxl')
+    print 'legacy: %.3f s, cached property rules: %.3f s, identical: %s' % (legacyTime, compiledTime, identical)
+    if not identical:
+        sys.exit(1)
+
+def benchmarkWrites(options):
+    path = options.path or 'bach/bwv84.5.mxl'
+    score = corpus.parse(path)
+    addMomentsToScore(score)
+    db = Database(options.uri)
+    settings = [(False, 100, None)]
+    for batchSize in (500, 2000, 5000):
+        for commitSize in (5000, 20000, 100000):
+            if commitSize >= batchSize:
+                settings.append((True, batchSize, commitSize))
+    print 'Writing %s to %s' % (path, options.uri)
+    fastest = None
+    for useTransactions, batchSize, commitSize in settings:
+        db.wipeDatabase(bulk=True)
+        db.useTransactions = useTransactions
+        if useTransactions:
+            db.transactionBatchSize = batchSize
+            db.commitSize = commitSize
+            label = 'UNWIND batch %d, commit %d' % (batchSize, commitSize)
+        else:
+            label = 'REST create, batch %d' % batchSize
+        stats = db.addScore(score)
+        writeTime = stats.phases['nodeWrite']['wall'] + stats.phases['edgeWrite']['wall']
+        entities = stats.nodeCount + stats.relationshipCount
+        print '%-32s %7.2f s  %8.0f entities/s  %5d requests' % (label, writeTime, 
+                                                                 entities / max(writeTime, 0.001), stats.serverCalls)
+        if useTransactions and (fastest is None or writeTime < fastest[0]):
+            fastest = (writeTime, batchSize, commitSize)
+    print 'Fastest: transactionBatchSize = %d, commitSize = %d' % fastest[1:]
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage='%prog moments|extract|writes [-p corpus_path] [-u uri]')
+    parser.add_option('-p', '--path', dest='path', default=None,
+                      help='-p|--path : corpus path of the score to use (default: a synthetic score for '
+                           'moments, the Goldberg Variations for extract, bwv84.5 for writes)')
+    parser.add_option('-u', '--uri', dest='uri', default='http://localhost:7474/db/data/',
+                      help='-u|--uri : location of the scratch database for writes')
+    (options, args) = parser.parse_args()
+    benchmarks = { 'moments': benchmarkMoments,
+                   'extract': benchmarkExtract,
+                   'writes': benchmarkWrites }
+    if len(args) != 1 or args[0] not in benchmarks:
+        parser.error('choose one of: ' + ', '.join(sorted(benchmarks)))
+    benchmarks[args[0]](options)
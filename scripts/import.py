@@ -11,9 +11,12 @@ from music21 import *
 db = Database() #auth_username='dfa639169', auth_password='9253bc680')
 path = 'bach/bwv84.5.mxl'
 s = music21.corpus.parse(path)
+stats = ImportStats(path)
+stats.startPhase('moments')
 addMomentsToScore(s)
-db.addScore(s, verbose=True)
-sys.exit()
+stats.endPhase('moments')
+db.addScore(s, verbose=True, stats=stats, skipIfPresent=True)
+stats.writeJSONLine(sys.stdout)
 #
 #path = 'bach'
 #works = corpus.getWorkList(path)
@@ -33,10 +36,9 @@ sys.exit()
 #sys.exit()
 
 works = corpus.getComposer('bach')
+paths = []
 for work in works:
     loc = work.find('corpus')
-    path = work[loc+7:]
-    print '\n' + work
-    s = corpus.parse(path)
-    addMomentsToScore(s)
-    db.addScore(s, verbose=True)
+    paths.append(work[loc+7:])
+for stats in db.addScores(paths, verbose=True, skipIfPresent=True):
+    stats.writeJSONLine(sys.stdout)
@@ -0,0 +1,17 @@
+#!/usr/bin/python
+
+# Builds the catalog that the Database.list* methods and the server read,
+# for a database whose scores were added before catalogs were kept.
+# This reads every node and relationship, so nothing should be imported meanwhile.
+
+import optparse
+from music21.musicNet import *
+
+parser = optparse.OptionParser()
+parser.add_option('-m', '--missing-only', dest='missingOnly', action='store_true', default=False,
+                  help='-m|--missing-only : do nothing if the database already has a catalog')
+(options, args) = parser.parse_args()
+
+db = Database()
+if not db.rebuildCatalog(missingOnly=options.missingOnly, verbose=True):
+    print 'The database already has a catalog.'